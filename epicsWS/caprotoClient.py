@@ -1,98 +1,287 @@
-from typing import Callable, Dict, Set, Any
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Set, Any
 from threading import Lock
 import caproto.threading.pyepics_compat as epics
+from caproto import SubscriptionType
+
+from lingerCache import LingerCache
+from pvParser import CA_METADATA_CHANGED
 
 
 class CaprotoClient:
     """
     Simplified client using caproto.threading.pyepics_compat (PyEpics-compatible).
     Handles per-client subscriptions and forwards raw callback data to the upper layer.
+    Channels connect in the background: subscribing never blocks on the network.
+    Channels without subscribers linger in an LRU cache for a grace period before being closed.
+    Control variables are read on connection and on property (DBE_PROPERTY) events only, and the
+    next update after such a read is flagged so the metadata is parsed again.
     """
 
-    def __init__(self, handle_update: Callable[[str, Any], None]):
+    def __init__(
+        self,
+        handle_update: Callable[[str, Any], None],
+        handle_status: Callable[[str, bool], None],
+        timeout: float = 5.0,
+        max_workers: int = 16,
+        linger_time: float = 30.0,
+        linger_size: int = 1000,
+    ):
         """
         handle_update: callable(pv_name: str, raw_data: dict)
+        handle_status: callable(pv_name: str, connected: bool), called on connection changes
+        timeout: timeout in seconds for reading control variables after connecting and for puts
+        max_workers: threads used to read control variables of newly connected channels
+        linger_time: seconds a channel stays open after its last unsubscribe
+        linger_size: max number of lingering channels
         """
         self._handle_update = handle_update
-        self._pvs: Dict[str, Any] = {}
+        self._handle_status = handle_status
+        self._timeout = timeout
+        self._pvs: Dict[str, Optional[Any]] = {}  # subscribed and lingering, None while created
         self._subscribers: Dict[str, Set[str]] = {}
+        self._monitored: Set[str] = set()
+        self._connected: Set[str] = set()
+        self._property_subs: Dict[str, Any] = {}  # pv_name -> DBE_PROPERTY subscription
+        self._property_seen: Set[str] = set()  # PVs which got their initial property event
+        self._metadata_read: Set[str] = set()  # PVs whose next update carries new metadata
         self._lock = Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="caproto-connect"
+        )
+        self._linger = LingerCache(self._close_channel, linger_time, linger_size)
 
     def _callback(self, value, **kwargs):
         """Generic callback for all PVs — passes raw data upstream."""
         pvname = kwargs.get("pvname")
-        if not pvname:
+        if not pvname or pvname not in self._subscribers:
+            # lingering channels keep their monitor but nobody needs their updates
             return
-        self._handle_update(pvname, {"value": value, **kwargs})
+        data = {"value": value, **kwargs}
+        if pvname in self._metadata_read:
+            self._metadata_read.discard(pvname)
+            data[CA_METADATA_CHANGED] = True
+        self._handle_update(pvname, data)
+
+    def _on_connection(self, pvname: str, conn: bool, pv: Any, **kwargs):
+        """Connection callback: reports the new state and sets up monitoring on connect."""
+        with self._lock:
+            if self._pvs.get(pvname) is not pv or conn == (pvname in self._connected):
+                return
+            if conn:
+                self._connected.add(pvname)
+            else:
+                self._connected.discard(pvname)
+                # the property subscription sends a new initial event on reconnection
+                self._property_seen.discard(pvname)
+            subscribed = pvname in self._subscribers
+
+        if subscribed:
+            self._handle_status(pvname, conn)
+        if conn:
+            self._executor.submit(self._setup_monitor, pvname, pv)
+
+    def _setup_monitor(self, pv_name: str, pv: Any):
+        """
+        Read control variables of a freshly (re)connected PV, so they are part of every callback,
+        then attach the update callback and push the current data.
+        """
+        self._read_metadata(pv_name, pv)
+
+        with self._lock:
+            if self._pvs.get(pv_name) is not pv:
+                return
+            first_connection = pv_name not in self._monitored
+            self._monitored.add(pv_name)
+
+        if first_connection:
+            pv.add_callback(self._callback, with_ctrlvars=False)
+            self._subscribe_property(pv_name, pv)
+        pv.run_callbacks()
+
+    def _read_metadata(self, pv_name: str, pv: Any):
+        """Read the control variables of a PV, flagging its next update."""
+        try:
+            pv.get_ctrlvars(timeout=self._timeout)
+        except Exception as e:
+            print(f"[caproto]: Failed to read control variables of {pv_name}: {e}")
+            return
+        self._metadata_read.add(pv_name)
+
+    def _subscribe_property(self, pv_name: str, pv: Any):
+        """Subscribe to property changes (units, limits, enum strings...) of a PV."""
+        try:
+            sub = pv._caproto_pv.subscribe(data_count=1, mask=SubscriptionType.DBE_PROPERTY)
+            sub.add_callback(self._on_property)
+        except Exception as e:
+            print(f"[caproto]: Failed to subscribe to property changes of {pv_name}: {e}")
+            return
+        with self._lock:
+            self._property_subs[pv_name] = sub
+
+    def _on_property(self, sub, response):
+        """DBE_PROPERTY callback: re-read the metadata and push it with the current value."""
+        pv_name = sub.pv.name
+        with self._lock:
+            pv = self._pvs.get(pv_name)
+            initial = pv_name not in self._property_seen
+            self._property_seen.add(pv_name)
+        if pv is None or initial:
+            # the initial event only mirrors the control variables read on connection
+            return
+        self._executor.submit(self._refresh_metadata, pv_name, pv)
+
+    def _refresh_metadata(self, pv_name: str, pv: Any):
+        """Read changed metadata and send it to the subscribers with the current value."""
+        self._read_metadata(pv_name, pv)
+        if pv_name in self._subscribers:
+            pv.run_callbacks()
 
     def subscribe(self, client_id: str, pv_name: str):
         """
         Subscribe a client to a PV.
-        On first subscription, creates the PV and attaches a callback.
+        On first subscription, reuses a lingering channel or creates the PV, which then connects in
+        the background.
         """
         with self._lock:
-            first_sub = pv_name not in self._pvs
+            first_sub = pv_name not in self._subscribers
             self._subscribers.setdefault(pv_name, set()).add(client_id)
+            lingering = first_sub and pv_name in self._pvs
+            if first_sub and not lingering:
+                self._pvs[pv_name] = None
+            pv = self._pvs[pv_name]
+            replay = lingering and pv_name in self._monitored and pv_name in self._connected
 
-        if first_sub:
-            try:
-                pv = epics.get_pv(pv_name)
-                pv.get_ctrlvars()
-                pv.add_callback(self._callback)
+        if not first_sub:
+            return
+        self._linger.revive(pv_name)
+        if lingering:
+            if replay:
+                # push the latest data of the lingering channel to the new subscriber
+                pv.run_callbacks()
+            return
+
+        try:
+            pv = epics.get_pv(pv_name, connect=False, connection_callback=self._on_connection)
+        except Exception as e:
+            print(f"[caproto]: Failed to subscribe to {pv_name}: {e}")
+            with self._lock:
+                if self._pvs.get(pv_name, False) is None:
+                    del self._pvs[pv_name]
+            return
+
+        with self._lock:
+            registered = pv_name in self._pvs
+            if registered:
                 self._pvs[pv_name] = pv
-            except Exception as e:
-                print(f"[caproto]: Failed to subscribe to {pv_name}: {e}")
+        if not registered:
+            # closed while the channel was being created
+            pv.disconnect()
+            return
+        # the connection may have completed before the PV was registered
+        if pv.connected:
+            self._on_connection(pv_name, True, pv)
 
     def unsubscribe(self, client_id: str, pv_name: str):
-        """Unsubscribe a client from a PV."""
+        """Unsubscribe a client from a PV. The channel lingers once its last client is gone."""
         with self._lock:
             clients = self._subscribers.get(pv_name)
             if not clients:
                 return
 
             clients.discard(client_id)
-            if not clients:
-                pv = self._pvs.pop(pv_name, None)
-                self._subscribers.pop(pv_name, None)
-                if pv:
-                    try:
-                        pv.clear_callbacks()
-                    except Exception as e:
-                        print(f"[caproto]: Failed to clear callbacks for {pv_name}: {e}")
-
-    def unsubscribe_all(self, client_id: str):
-        """Remove a client from all subscriptions."""
+            released = not clients
+            if released:
+                del self._subscribers[pv_name]
+
+        if released:
+            self._linger.release(pv_name)
+
+    def _close_channel(self, pv_name: str):
+        """Close a channel whose linger period is over, unless it was subscribed again."""
         with self._lock:
-            empty_pvs = [
-                pv
-                for pv, clients in self._subscribers.items()
-                if client_id in clients and len(clients) == 1
-            ]
+            if pv_name in self._subscribers or pv_name not in self._pvs:
+                return
+            pv = self._pvs.pop(pv_name)
+            property_sub = self._property_subs.pop(pv_name, None)
+            self._monitored.discard(pv_name)
+            self._connected.discard(pv_name)
+            self._property_seen.discard(pv_name)
+            self._metadata_read.discard(pv_name)
 
-        for pv in empty_pvs:
-            self.unsubscribe(client_id, pv)
+        if pv:
+            try:
+                if property_sub:
+                    property_sub.clear()
+                pv.clear_callbacks()
+                pv.disconnect()
+            except Exception as e:
+                print(f"[caproto]: Failed to close {pv_name}: {e}")
+
+    def is_connected(self, pv_name: str) -> bool:
+        """Whether the channel of a subscribed PV is currently connected."""
+        with self._lock:
+            return pv_name in self._connected
+
+    def linger_stats(self) -> Dict[str, int]:
+        """Size and hit/eviction counters of the lingering channel cache."""
+        return self._linger.stats()
 
     def write_to_pv(self, pv_name: str, value: Any):
-        """Write synchronously to a PV."""
+        """
+        Write synchronously to a PV, waiting for the IOC to complete the put.
+        Blocks, so it should be run off the event loop. Raises on failure.
+        """
         with self._lock:
-            pv = self._pvs.get(pv_name)
+            pv = self._pvs.get(pv_name) if pv_name in self._subscribers else None
         if not pv:
-            print(f"[caproto]: Cannot write: PV {pv_name} not subscribed.")
-            return
+            raise ValueError(f"Cannot write: PV {pv_name} not subscribed")
+
+        pv.put(value, wait=True, timeout=self._timeout)
 
+    def get(self, pv_name: str, timeout: float) -> Dict[str, Any]:
+        """
+        One-shot read of a PV with its control variables, without monitoring it. The channel is
+        released afterwards, unless it is also monitored.
+        Blocks, so it should be run off the event loop. Raises on failure.
+        """
+        deadline = time.monotonic() + timeout
+        pv = epics.get_pv(pv_name, connect=False)
         try:
-            pv.put(value)
-        except Exception as e:
-            print(f"[caproto]: Write to {pv_name} failed: {e}")
+            if not pv.wait_for_connection(timeout=timeout):
+                raise TimeoutError(f"{pv_name} did not connect within {timeout} s")
+            data = {}
+            # control variables, then value, alarm and time stamp
+            for form in ("ctrl", "time"):
+                remaining = max(deadline - time.monotonic(), 0.0)
+                reading = pv.get_with_metadata(form=form, timeout=remaining, use_monitor=False)
+                if reading is None:
+                    raise TimeoutError(f"Reading {pv_name} timed out")
+                data.update(reading)
+            return data
+        finally:
+            pv.disconnect()
 
     def close(self):
         """Stop all subscriptions and clear resources."""
+        self._linger.clear()
         with self._lock:
             for pv_name, pv in self._pvs.items():
+                if not pv:
+                    continue
                 try:
                     pv.clear_callbacks()
                 except Exception as e:
                     print(f"[caproto]: Failed to clear callbacks for {pv_name}: {e}")
+            for sub in self._property_subs.values():
+                sub.clear()
             self._pvs.clear()
             self._subscribers.clear()
+            self._monitored.clear()
+            self._connected.clear()
+            self._property_subs.clear()
+            self._property_seen.clear()
+            self._metadata_read.clear()
+        self._executor.shutdown(wait=False, cancel_futures=True)
         print("[caproto]: Closed all subscriptions.")
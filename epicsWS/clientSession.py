@@ -0,0 +1,249 @@
+import asyncio
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Hashable, List, Optional, Set, Tuple, Union
+
+from websockets.exceptions import ConnectionClosed
+from websockets.legacy.server import WebSocketServerProtocol
+
+import metrics
+from deadbandFilter import DeadbandFilter
+from frameEncoder import UpdateFrames
+from subscriptionRegistry import ChannelKey
+
+COALESCE_POLICY = "coalesce"
+DROP_OLDEST_POLICY = "drop-oldest"
+DISCONNECT_POLICY = "disconnect"
+QUEUE_POLICIES = (COALESCE_POLICY, DROP_OLDEST_POLICY, DISCONNECT_POLICY)
+
+# queued update: (pv, frames, with_metadata), encoded for this client only when it is sent
+QueuedUpdate = Tuple[ChannelKey, UpdateFrames, bool]
+
+
+class ClientSession:
+    """
+    State of one websocket client and its bounded outbound queue.
+    Updates are queued per PV and sent by a dedicated writer task, so a slow client only delays
+    itself. When the queue is full, the slow-consumer policy decides what happens:
+    - coalesce: a queued update of a PV is replaced by its newer one, otherwise the oldest is
+      dropped
+    - drop-oldest: plain FIFO, the oldest queued update is dropped
+    - disconnect: updates are coalesced per PV, and the client is disconnected on overflow
+    Control messages (status, results) are never dropped and are sent before pending updates.
+    In delta mode, an update only carries the fields that changed since the last update of the PV
+    sent to this client, with a full update every resync interval.
+    In batch mode, the updates queued during a batch interval are sent as one `updates` message.
+    Deadband filters drop updates of a PV before they are queued, unless they carry metadata.
+    """
+
+    def __init__(
+        self,
+        ws: WebSocketServerProtocol,
+        client_id: str,
+        max_queue: int = 1000,
+        policy: str = COALESCE_POLICY,
+        resync_interval: float = 30.0,
+    ):
+        if policy not in QUEUE_POLICIES:
+            raise ValueError(f"[epicsWS]: Unsupported queue policy: {policy}")
+        self.ws = ws
+        self.client_id = client_id
+        self.binary = False  # binary frames negotiated for array updates
+        self.delta = False  # delta updates negotiated
+        self.batch_interval = 0.0  # seconds between batched update messages, 0: not batched
+        self.max_points: Dict[ChannelKey, int] = {}  # pv -> requested array resolution
+        self.array_dtypes: Dict[ChannelKey, str] = {}  # pv -> requested array wire dtype
+        self.filters: Dict[ChannelKey, DeadbandFilter] = {}  # pv -> deadband of the subscription
+        self.sent_metadata: Set[ChannelKey] = set()  # PVs whose metadata was already queued
+        self.channel_status: Dict[ChannelKey, bool] = {}  # pv -> connection state last reported
+        self.dropped = 0  # updates dropped because of the queue limit
+        self._max_queue = max_queue
+        self._policy = policy
+        self._updates: "OrderedDict[Hashable, QueuedUpdate]" = OrderedDict()
+        self._control: Deque[Union[str, bytes]] = deque()
+        self._seq = 0  # unique keys for updates that must not be coalesced
+        self._ready = asyncio.Event()
+        self._batch_at = 0.0  # loop time from which the next batch can be sent
+        self._closing = False
+        self._resync_interval = resync_interval
+        # pv -> (last frames sent, time of the last full update), for delta updates
+        self._last_sent: Dict[ChannelKey, Tuple[UpdateFrames, float]] = {}
+
+    @property
+    def depth(self) -> int:
+        """Number of messages waiting to be sent."""
+        return len(self._updates) + len(self._control)
+
+    def send(self, message: Union[str, bytes]):
+        """Queue a control message. Never dropped or coalesced."""
+        self._control.append(message)
+        self._ready.set()
+
+    def send_update(self, pv: ChannelKey, frames: UpdateFrames):
+        """Queue an update of a PV, applying the slow-consumer policy."""
+        if self._closing:
+            return
+        with_metadata = pv not in self.sent_metadata
+        deadband = self.filters.get(pv)
+        if deadband is not None and not deadband.passes(frames.pv_data, force=with_metadata):
+            return
+        self.sent_metadata.add(pv)
+
+        if self._policy == DROP_OLDEST_POLICY:
+            self._seq += 1
+            key = (pv, self._seq)
+        else:
+            key = pv
+            queued = self._updates.get(key)
+            if queued is not None:
+                # keep the queue position, carry over metadata not sent yet
+                self._updates[key] = (pv, frames, with_metadata or queued[2])
+                return
+
+        if len(self._updates) >= self._max_queue:
+            if self._policy == DISCONNECT_POLICY:
+                self._disconnect()
+                return
+            self._drop_oldest()
+
+        self._updates[key] = (pv, frames, with_metadata)
+        if len(self._updates) == 1:
+            # the writer only waits for updates once the queue is empty
+            self._ready.set()
+
+    def _drop_oldest(self):
+        _, (pv, _, with_metadata) = self._updates.popitem(last=False)
+        if with_metadata:
+            # the next update of this PV has to carry the metadata again
+            self.sent_metadata.discard(pv)
+        if not self.dropped:
+            print(f"[epicsWS]: Client {self.client_id} is too slow, dropping updates")
+        self.dropped += 1
+
+    def _disconnect(self):
+        print(f"[epicsWS]: Client {self.client_id} is too slow, disconnecting")
+        self._closing = True
+        self._updates.clear()
+        asyncio.ensure_future(self.ws.close(1013, "Slow consumer"))
+
+    def resend_metadata(self, pv: ChannelKey):
+        """Include the metadata of a PV in its next update again, after it changed."""
+        self.sent_metadata.discard(pv)
+
+    def reset_filter(self, pv: ChannelKey):
+        """Let the next update of a PV through its deadband, e.g. after a reconnection."""
+        deadband = self.filters.get(pv)
+        if deadband is not None:
+            deadband.reset()
+
+    def resync(self, pv: ChannelKey):
+        """Send the next update of a PV in full, metadata included."""
+        self.sent_metadata.discard(pv)
+        self._last_sent.pop(pv, None)
+
+    def forget(self, pv: ChannelKey):
+        """Drop state and pending updates of a PV the client unsubscribed from."""
+        self.sent_metadata.discard(pv)
+        self.channel_status.pop(pv, None)
+        self._last_sent.pop(pv, None)
+        self.max_points.pop(pv, None)
+        self.array_dtypes.pop(pv, None)
+        self.filters.pop(pv, None)
+        for key in [k for k, queued in self._updates.items() if queued[0] == pv]:
+            del self._updates[key]
+
+    def _encode_update(
+        self, pv: ChannelKey, frames: UpdateFrames, with_metadata: bool
+    ) -> Optional[Union[str, bytes]]:
+        """Pick the frame of an update for this client. None if there is nothing to send."""
+        points = self.max_points.get(pv)
+        if points:
+            frames = frames.decimated(points)
+        dtype = self.array_dtypes.get(pv)
+        if dtype:
+            frames = frames.cast(dtype)
+        if not self.delta:
+            return frames.frame(with_metadata, self.binary)
+
+        now = time.monotonic()
+        last = self._last_sent.get(pv)
+        if last is None or with_metadata or now - last[1] >= self._resync_interval:
+            self._last_sent[pv] = (frames, now)
+            return frames.frame(with_metadata, self.binary)
+
+        last_frames, synced_at = last
+        self._last_sent[pv] = (frames, synced_at)
+        return frames.delta_frame(last_frames, self.binary)
+
+    def _next_update(self) -> Optional[Union[str, bytes]]:
+        while self._updates:
+            _, (pv, frames, with_metadata) = self._updates.popitem(last=False)
+            message = self._encode_update(pv, frames, with_metadata)
+            if message is not None:
+                metrics.updates_out.inc(metrics.channel_labels(pv))
+                metrics.update_latency_seconds.observe(time.perf_counter() - frames.created)
+                return message
+        return None
+
+    def _next_batch(self) -> List[Union[str, bytes]]:
+        """
+        Encode all queued updates: JSON ones are packed into a single `updates` message, binary
+        frames are sent as is.
+        """
+        entries: List[str] = []
+        messages: List[Union[str, bytes]] = []
+        while self._updates:
+            message = self._next_update()
+            if isinstance(message, bytes):
+                messages.append(message)
+            elif message is not None:
+                entries.append(message)
+        if len(entries) > 1:
+            # entries are already encoded, possibly shared with other clients: join, don't re-encode
+            messages.append('{"type": "updates", "updates": [' + ", ".join(entries) + "]}")
+        else:
+            messages.extend(entries)
+        return messages
+
+    async def _wait(self, timeout: Optional[float] = None):
+        self._ready.clear()
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _send(self, message: Union[str, bytes]):
+        start = time.perf_counter()
+        await self.ws.send(message)
+        metrics.send_seconds.observe(time.perf_counter() - start)
+
+    async def run(self):
+        """
+        Writer loop: send queued messages until the connection closes. The connection is closed if
+        encoding or sending fails, so that the session gets cleaned up.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                if self._control:
+                    await self._send(self._control.popleft())
+                elif not self._updates:
+                    await self._wait()
+                elif self.batch_interval <= 0:
+                    message = self._next_update()
+                    if message is not None:
+                        await self._send(message)
+                elif loop.time() < self._batch_at:
+                    # let updates accumulate, control messages still wake the writer up
+                    await self._wait(self._batch_at - loop.time())
+                else:
+                    self._batch_at = loop.time() + self.batch_interval
+                    for message in self._next_batch():
+                        await self._send(message)
+        except ConnectionClosed:
+            pass
+        except Exception as e:
+            print(f"[epicsWS]: Failed to send to client {self.client_id}, disconnecting: {e!r}")
+            self._closing = True
+            self._updates.clear()
+            await self.ws.close(1011, "Internal error")
@@ -0,0 +1,63 @@
+from dataclasses import dataclass, field
+from typing import Any, Optional, Tuple
+
+from pvParser import PVData
+
+
+@dataclass
+class DeadbandFilter:
+    """
+    Per-client, per-PV filter of monitor updates, applied before they are queued and encoded.
+    An update passes when its alarm severity or status changed, or when its scalar numeric value
+    moved by more than the deadband from the last value that passed:
+    - absolute: deadband in engineering units
+    - percent: deadband in percent of the display range, or of the last value if it has none
+    With alarm_only, only alarm changes pass. Arrays and non-numeric values are never deadbanded.
+    """
+
+    absolute: float = 0.0
+    percent: float = 0.0
+    alarm_only: bool = False
+    _last_value: Any = field(default=None, init=False, repr=False)
+    _last_alarm: Optional[Tuple[int, int]] = field(default=None, init=False, repr=False)
+    _primed: bool = field(default=False, init=False, repr=False)
+
+    def reset(self):
+        """Let the next update pass, e.g. after a reconnection."""
+        self._primed = False
+
+    def _deadband(self, pv_data: PVData) -> float:
+        deadband = self.absolute
+        if self.percent > 0:
+            display = pv_data.metadata.display if pv_data.metadata else None
+            if display and display.limitLow is not None and display.limitHigh is not None:
+                span = display.limitHigh - display.limitLow
+            else:
+                span = 0.0
+            span = abs(span) or abs(self._last_value)
+            deadband = max(deadband, span * self.percent / 100.0)
+        return deadband
+
+    def _value_passes(self, pv_data: PVData) -> bool:
+        value = pv_data.value
+        if pv_data.array is not None or isinstance(value, (list, str)):
+            return True
+        if not isinstance(value, (int, float)) or not isinstance(self._last_value, (int, float)):
+            return value != self._last_value
+        return abs(value - self._last_value) > self._deadband(pv_data)
+
+    def passes(self, pv_data: PVData, force: bool = False) -> bool:
+        """Whether an update should be sent, recording it as the last sent one if so."""
+        alarm = (pv_data.alarm.severity, pv_data.alarm.status) if pv_data.alarm else None
+        if force or not self._primed or alarm != self._last_alarm:
+            passed = True
+        elif self.alarm_only:
+            passed = False
+        else:
+            passed = self._value_passes(pv_data)
+
+        if passed:
+            self._primed = True
+            self._last_alarm = alarm
+            self._last_value = pv_data.value
+        return passed
@@ -1,132 +1,707 @@
 import asyncio
 import json
+import multiprocessing
 import os
+import signal
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import numpy as np
 import websockets
 from websockets.legacy.server import WebSocketServerProtocol
-from typing import Dict, Set, Tuple
-
-from pvParser import PVParser, PVData
-from p4pClient import P4PClient
-from caprotoClient import CaprotoClient
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+from pvParser import PVParser, PVData, PVMetadata, encode_base64_array
+from simClient import SimClient
+from updateCoalescer import UpdateCoalescer
+from loopHandoff import LoopHandoff
+import metrics
+from frameEncoder import (
+    ARRAY_DTYPES,
+    NATIVE,
+    UpdateFrames,
+    encode_binary_message,
+    encode_message,
+)
+from pvWriter import PVWriter, WriteResult
+from clientSession import ClientSession, COALESCE_POLICY, QUEUE_POLICIES
+from deadbandFilter import DeadbandFilter
+from historyBuffer import HistoryStore
+from pvPrewarm import PREWARM_ID, PrewarmSubscriber, load_pv_names
+from subscriptionRegistry import ChannelKey, SubscriptionRegistry
+from remoteClient import RemoteClient, UpstreamLink
+from upstreamServer import UpstreamServer
 
 CA_PROVIDER_KEY = "ca"
 PVA_PROVIDER_KEY = "pva"
+SIM_PROVIDER_KEY = "sim"
+
+# connected websocket clients
+sessions: Dict[WebSocketServerProtocol, ClientSession] = {}
+
+# client sessions subscribed to each (provider, PV) channel, grouped by max update rate (Hz) so
+# that sessions at the same rate are flushed together, and channels of each session
+registry = SubscriptionRegistry()
 
-# map PV -> set of websocket clients
-subscriptions: Dict[str, Set[WebSocketServerProtocol]] = {}
+# latest parsed update per channel, as shared frames. Reused by update groups flushing the same raw
+# update and sent right away to clients subscribing to an already monitored PV. Entries live as long
+# as the channel has subscribers
+latest_frames: Dict[ChannelKey, UpdateFrames] = {}
 
-# track if metadata has been sent per (ws, pv_name)
-sent_metadata: Dict[Tuple[WebSocketServerProtocol, str], bool] = {}
+# parsed metadata per channel, reused by value-only updates until the provider reports a change
+pv_metadata: Dict[ChannelKey, PVMetadata] = {}
+stale_metadata: Set[ChannelKey] = set()
 
 # holds one client per backend
-clients = {PVA_PROVIDER_KEY: None, CA_PROVIDER_KEY: None}
+clients = {PVA_PROVIDER_KEY: None, CA_PROVIDER_KEY: None, SIM_PROVIDER_KEY: None}
+
+# connection to the upstream process, in the websocket workers of the sharded mode
+upstream: Optional[UpstreamLink] = None
+
+# server of the websocket workers, in the upstream process of the sharded mode, which owns the
+# channels and reports their stats
+upstream_server: Optional[UpstreamServer] = None
 
 # environment variable fallback
 DEFAULT_PROTOCOL = os.getenv("EPICS_DEFAULT_PROTOCOL", PVA_PROVIDER_KEY).lower()
 
-
-def parse_protocol(pv_name: str) -> str:
+# default max update rate (Hz) per PV per client, overridable per subscribe. 0 disables throttling
+DEFAULT_MAX_RATE = float(os.getenv("EPICS_WS_MAX_RATE", "30"))
+
+# seconds after which a PV that did not connect is reported as disconnected
+CONNECT_TIMEOUT = float(os.getenv("EPICS_WS_CONNECT_TIMEOUT", "5"))
+
+# max queued updates per client and what to do with clients that can't keep up
+QUEUE_SIZE = int(os.getenv("EPICS_WS_QUEUE_SIZE", "1000"))
+QUEUE_POLICY = os.getenv("EPICS_WS_QUEUE_POLICY", COALESCE_POLICY).lower()
+if QUEUE_POLICY not in QUEUE_POLICIES:
+    raise ValueError(f"[epicsWS]: EPICS_WS_QUEUE_POLICY must be one of {', '.join(QUEUE_POLICIES)}")
+
+# how long (s) and how many upstream channels stay open after their last unsubscribe
+LINGER_TIME = float(os.getenv("EPICS_WS_LINGER_TIME", "30"))
+LINGER_SIZE = int(os.getenv("EPICS_WS_LINGER_SIZE", "1000"))
+
+# update rate (Hz) of simulated (sim://) PVs whose name does not set one
+SIM_RATE = float(os.getenv("EPICS_WS_SIM_RATE", "10"))
+
+# samples of history kept per scalar PV (0 disables it), and memory cap (MiB) of all histories
+HISTORY_DEPTH = int(os.getenv("EPICS_WS_HISTORY_DEPTH", "0"))
+HISTORY_MEMORY = float(os.getenv("EPICS_WS_HISTORY_MEMORY", "64"))
+
+# PVA monitors: value fields only with metadata monitored separately (0 requests full structures),
+# server-side queue size (0: server default) and pipelining
+PVA_NARROW_MONITOR = os.getenv("EPICS_WS_PVA_NARROW_MONITOR", "1") != "0"
+PVA_QUEUE_SIZE = int(os.getenv("EPICS_WS_PVA_QUEUE_SIZE", "0"))
+PVA_PIPELINE = os.getenv("EPICS_WS_PVA_PIPELINE", "0") != "0"
+
+# seconds between full updates of a PV sent to clients using delta updates
+RESYNC_INTERVAL = float(os.getenv("EPICS_WS_RESYNC_INTERVAL", "30"))
+
+# default interval (s) between the batched update messages of clients enabling batchUpdates
+BATCH_INTERVAL = float(os.getenv("EPICS_WS_BATCH_INTERVAL", "0.05"))
+
+# default wire dtype of array updates, overridable per subscribe: native (as parsed from the source
+# dtype), float32 (narrows float arrays) or float64 (widens all arrays)
+ARRAY_DTYPE = os.getenv("EPICS_WS_ARRAY_DTYPE", NATIVE).lower()
+if ARRAY_DTYPE not in ARRAY_DTYPES:
+    raise ValueError(f"[epicsWS]: EPICS_WS_ARRAY_DTYPE must be one of {', '.join(ARRAY_DTYPES)}")
+
+# PVs connected at startup and kept subscribed, so the first clients get their values right away:
+# comma-separated OPI files (.json) or PV lists (one PV per line), as paths or glob patterns. Their
+# latest update is refreshed at the given rate (Hz) while no client subscribes to them
+PREWARM_FILES = [
+    path.strip() for path in os.getenv("EPICS_WS_PREWARM", "").split(",") if path.strip()
+]
+PREWARM_RATE = float(os.getenv("EPICS_WS_PREWARM_RATE", "1"))
+
+# default and max timeout (s) of the one-shot reads of get requests, and threads running them
+GET_TIMEOUT = float(os.getenv("EPICS_WS_GET_TIMEOUT", "2"))
+GET_MIN_TIMEOUT = 0.1
+GET_MAX_TIMEOUT = 30.0
+GET_WORKERS = int(os.getenv("EPICS_WS_GET_WORKERS", "32"))
+
+# local HTTP endpoint serving Prometheus metrics on /metrics, 0 disables it. In sharded mode, the
+# upstream process uses this port and worker i the port + 1 + i
+METRICS_HOST = os.getenv("EPICS_WS_METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("EPICS_WS_METRICS_PORT", "9101"))
+
+# sharded mode: number of websocket worker processes sharing the port behind one upstream process
+# owning the channels. 1 runs everything in a single process
+WORKERS = int(os.getenv("EPICS_WS_WORKERS", "1"))
+IPC_PATH = os.getenv("EPICS_WS_IPC_PATH") or os.path.join(
+    tempfile.gettempdir(), f"epicsWS-{os.getpid()}.sock"
+)
+
+
+def parse_protocol(pv_name: str) -> ChannelKey:
     """Decide protocol from PV prefix or default env var.
     Returns PV without protocol prefix"""
     if pv_name.startswith("pva://"):
         return PVA_PROVIDER_KEY, pv_name[6:]
     elif pv_name.startswith("ca://"):
         return CA_PROVIDER_KEY, pv_name[5:]
+    elif pv_name.startswith("sim://"):
+        return SIM_PROVIDER_KEY, pv_name[6:]
     return DEFAULT_PROTOCOL, pv_name
 
 
-async def send_update(pv_name: str, pv_obj, provider: str):
-    pv_data: PVData = (
-        PVParser.from_p4p(pv_obj, pv_name)
-        if provider == PVA_PROVIDER_KEY
-        else PVParser.from_caproto(pv_obj, pv_name)
+def client_pv_name(pv_name: str, provider: str) -> str:
+    """PV name as seen by the clients: prefixed with the provider unless it is the default one."""
+    if provider != DEFAULT_PROTOCOL:
+        return f"{provider}://{pv_name}"
+    return pv_name
+
+
+def add_subscriber(session: ClientSession, key: ChannelKey, rate: float):
+    """
+    Register a client for a channel at the given max update rate, resetting the state of a previous
+    subscription.
+    """
+    session.forget(key)
+    previous_rate = registry.add(session, key, rate)
+    if previous_rate is not None and previous_rate != rate:
+        release_group(key, previous_rate)
+
+
+def remove_subscriber(session: ClientSession, key: ChannelKey) -> bool:
+    """Remove a client from a channel. Returns whether it was subscribed."""
+    rate = registry.remove(session, key)
+    if rate is None:
+        return False
+    release_group(key, rate)
+    return True
+
+
+def release_group(key: ChannelKey, rate: float):
+    """Drop the state of an update group, and of its channel, once they have no subscribers."""
+    if registry.group(key, rate):
+        return
+    coalescer.discard((key, rate))
+    if key not in registry:
+        latest_frames.pop(key, None)
+        pv_metadata.pop(key, None)
+        stale_metadata.discard(key)
+
+
+def parse_rate(msg: dict) -> float:
+    """Read the optional maxRate field of a subscribe message, falling back to the default."""
+    rate = msg.get("maxRate")
+    if rate is None:
+        return DEFAULT_MAX_RATE
+    try:
+        rate = float(rate)
+    except (TypeError, ValueError):
+        print(f"[epicsWS]: Invalid maxRate {rate!r}, using default {DEFAULT_MAX_RATE}")
+        return DEFAULT_MAX_RATE
+    return rate if rate > 0 else 0.0
+
+
+def parse_points(msg: dict) -> int:
+    """
+    Read the optional maxPoints field of a subscribe message: arrays are decimated to this many
+    points. 0 (the default) keeps the full resolution.
+    """
+    points = msg.get("maxPoints")
+    if points is None:
+        return 0
+    try:
+        points = int(points)
+    except (TypeError, ValueError):
+        print(f"[epicsWS]: Invalid maxPoints {points!r}, using full resolution")
+        return 0
+    return points if points >= 2 else 0
+
+
+def parse_array_dtype(msg: dict) -> str:
+    """Read the optional arrayDtype field of a subscribe or get message: wire dtype of arrays."""
+    dtype = msg.get("arrayDtype")
+    if dtype is None:
+        return ARRAY_DTYPE
+    if dtype not in ARRAY_DTYPES:
+        print(f"[epicsWS]: Invalid arrayDtype {dtype!r}, using default {ARRAY_DTYPE}")
+        return ARRAY_DTYPE
+    return dtype
+
+
+def parse_deadband(msg: dict) -> Optional[Tuple[float, float, bool]]:
+    """
+    Read the optional deadband fields of a subscribe message: deadband (engineering units),
+    deadbandPercent (of the display range) and alarmOnly. None if no filtering is requested.
+    """
+    limits = []
+    for key in ("deadband", "deadbandPercent"):
+        limit = msg.get(key)
+        try:
+            limit = max(float(limit), 0.0) if limit is not None else 0.0
+        except (TypeError, ValueError):
+            print(f"[epicsWS]: Invalid {key} {limit!r}, ignoring it")
+            limit = 0.0
+        limits.append(limit)
+    alarm_only = bool(msg.get("alarmOnly"))
+    if not alarm_only and not any(limits):
+        return None
+    return limits[0], limits[1], alarm_only
+
+
+def parse_batch_interval(msg: dict) -> float:
+    """
+    Read the batch options of a config message: seconds between batched update messages, from the
+    optional batchInterval field or the server default. 0 if batchUpdates is not enabled.
+    """
+    if not msg.get("batchUpdates"):
+        return 0.0
+    interval = msg.get("batchInterval")
+    if interval is None:
+        return BATCH_INTERVAL
+    try:
+        interval = float(interval)
+    except (TypeError, ValueError):
+        print(f"[epicsWS]: Invalid batchInterval {interval!r}, using default {BATCH_INTERVAL}")
+        return BATCH_INTERVAL
+    return min(max(interval, 0.0), 1.0)
+
+
+def parse_get_timeout(msg: dict) -> float:
+    """Read the optional timeout field of a get message, in seconds."""
+    timeout = msg.get("timeout")
+    if timeout is None:
+        return GET_TIMEOUT
+    try:
+        timeout = float(timeout)
+    except (TypeError, ValueError):
+        print(f"[epicsWS]: Invalid get timeout {timeout!r}, using default {GET_TIMEOUT}")
+        return GET_TIMEOUT
+    return min(max(timeout, GET_MIN_TIMEOUT), GET_MAX_TIMEOUT)
+
+
+def create_client(protocol: str, handle_update, handle_status):
+    """
+    Create the client of a provider: channels owned by this process, or by the upstream process
+    in the workers of the sharded mode.
+    """
+    if upstream is not None:
+        return RemoteClient(
+            protocol,
+            upstream,
+            handle_update,
+            handle_status,
+            lambda pv_name: registry.max_rate((protocol, pv_name)),
+            timeout=CONNECT_TIMEOUT,
+        )
+    # provider libraries are imported on first use: a CA-only gateway never loads p4p, and the
+    # workers of the sharded mode load none
+    if protocol == PVA_PROVIDER_KEY:
+        from p4pClient import P4PClient
+
+        return P4PClient(
+            handle_update,
+            handle_status,
+            timeout=CONNECT_TIMEOUT,
+            linger_time=LINGER_TIME,
+            linger_size=LINGER_SIZE,
+            narrow_monitor=PVA_NARROW_MONITOR,
+            queue_size=PVA_QUEUE_SIZE,
+            pipeline=PVA_PIPELINE,
+        )
+    if protocol == CA_PROVIDER_KEY:
+        from caprotoClient import CaprotoClient
+
+        return CaprotoClient(
+            handle_update,
+            handle_status,
+            timeout=CONNECT_TIMEOUT,
+            linger_time=LINGER_TIME,
+            linger_size=LINGER_SIZE,
+        )
+    if protocol == SIM_PROVIDER_KEY:
+        return SimClient(handle_update, handle_status, default_rate=SIM_RATE)
+    raise ValueError(f"[epicsWS]: Unsupported protocol: {protocol}")
+
+
+def get_client(protocol: str):
+    """Client of a provider, created on first use."""
+    if protocol not in clients:
+        raise ValueError(f"[epicsWS]: Unsupported protocol: {protocol}")
+    if clients[protocol] is None:
+
+        def callback(pv_name, pv_obj):
+            handoff.push(queue_update, (protocol, pv_name), pv_obj)
+
+        def status_callback(pv_name, connected):
+            handoff.push(send_status, (protocol, pv_name), connected)
+
+        clients[protocol] = create_client(protocol, callback, status_callback)
+    return clients[protocol]
+
+
+def metadata_changed(pv_obj, provider: str) -> bool:
+    """Whether a raw monitor update reports a metadata change."""
+    if isinstance(pv_obj, PVData):
+        # parsed by the upstream process, which tracks metadata changes itself
+        return False
+    if provider == PVA_PROVIDER_KEY:
+        return PVParser.p4p_metadata_changed(pv_obj)
+    return PVParser.caproto_metadata_changed(pv_obj)
+
+
+def record_history(key: ChannelKey, pv_obj):
+    """Append a monitor update to the history of its PV, without parsing all of it."""
+    if isinstance(pv_obj, PVData):
+        # sharded mode: parsed by the upstream process
+        history.record(key, pv_obj)
+    elif key[0] == PVA_PROVIDER_KEY:
+        history.record_sample(key, *PVParser.p4p_sample(pv_obj))
+    else:
+        # simulated PVs use the format of CA updates
+        history.record_sample(key, *PVParser.caproto_sample(pv_obj))
+
+
+def queue_update(key: ChannelKey, pv_obj):
+    """Hand a raw monitor update to the coalescer, once per update group of the channel."""
+    if history.enabled:
+        # every update, before throttling, lingering channels included
+        record_history(key, pv_obj)
+    if key not in registry:
+        return
+    metrics.updates_in.inc(metrics.channel_labels(key))
+    # checked on every event: the coalescer may skip the update reporting the change
+    if metadata_changed(pv_obj, key[0]):
+        stale_metadata.add(key)
+    for rate in registry.rates(key):
+        coalescer.push((key, rate), pv_obj, rate)
+
+
+def flush_update(group_key: Tuple[ChannelKey, float], pv_obj):
+    """Coalescer flush callback: send the latest update of a channel to one update group."""
+    key, rate = group_key
+    send_update(key, pv_obj, rate)
+
+
+coalescer = UpdateCoalescer(flush_update)
+
+# runs provider puts off the event loop, one in-flight write per PV
+pv_writer = PVWriter()
+
+# batches monitor callbacks from provider threads into single event loop wakeups
+handoff = LoopHandoff()
+
+# runs the blocking one-shot provider reads of get requests
+pv_reader = ThreadPoolExecutor(max_workers=GET_WORKERS, thread_name_prefix="pv-get")
+
+# recent samples of scalar PVs, returned by history requests
+history = HistoryStore(HISTORY_DEPTH, int(HISTORY_MEMORY * 2**20))
+
+# subscriber holding the pre-warmed channels
+prewarmer = PrewarmSubscriber()
+
+
+def parse_metadata(pv_obj, provider: str) -> PVMetadata:
+    # simulated PVs use the format of CA updates
+    if provider == PVA_PROVIDER_KEY:
+        return PVParser.p4p_metadata(pv_obj)
+    return PVParser.caproto_metadata(pv_obj)
+
+
+def parse_update(
+    pv_name: str, pv_obj, provider: str, metadata: Optional[PVMetadata] = None
+) -> PVData:
+    start = time.perf_counter()
+    if provider == PVA_PROVIDER_KEY:
+        pv_data = PVParser.from_p4p(pv_obj, pv_name, metadata)
+    else:
+        pv_data = PVParser.from_caproto(pv_obj, pv_name, metadata)
+    metrics.parse_seconds.observe(time.perf_counter() - start, (provider,))
+    return pv_data
+
+
+def set_metadata(key: ChannelKey, metadata: PVMetadata):
+    """Store the metadata of a channel. When it changed, it is sent again to every subscriber."""
+    previous = pv_metadata.get(key)
+    if previous is not None and previous is not metadata:
+        for session in registry.subscribers(key):
+            session.resend_metadata(key)
+    pv_metadata[key] = metadata
+
+
+def get_metadata(key: ChannelKey, pv_obj) -> PVMetadata:
+    """Return the parsed metadata of a PV, parsed only for the first update or after a change."""
+    metadata = pv_metadata.get(key)
+    if metadata is not None and key not in stale_metadata:
+        return metadata
+
+    stale_metadata.discard(key)
+    parsed = parse_metadata(pv_obj, key[0])
+    if parsed == metadata:
+        return metadata
+    set_metadata(key, parsed)
+    return parsed
+
+
+def get_frames(key: ChannelKey, pv_obj) -> UpdateFrames:
+    """Parse a raw update into shared frames, reusing them if this update was already parsed."""
+    frames = latest_frames.get(key)
+    if frames is not None and frames.source is pv_obj:
+        return frames
+
+    provider, pv_name = key
+    if isinstance(pv_obj, PVData):
+        # sharded mode: already parsed by the upstream process
+        pv_data = pv_obj
+        set_metadata(key, pv_data.metadata)
+    else:
+        pv_data = parse_update(pv_name, pv_obj, provider, get_metadata(key, pv_obj))
+
+    frames = UpdateFrames(client_pv_name(pv_name, provider), pv_data, pv_obj)
+    latest_frames[key] = frames
+    return frames
+
+
+def send_update(key: ChannelKey, pv_obj, rate: float):
+    """
+    Queue an update to the clients of one update group. The frames are shared: each variant is
+    encoded once, by the first client writer sending it.
+    """
+    group = registry.group(key, rate)
+    if not group:
+        return
+
+    frames = get_frames(key, pv_obj)
+    for session in group:
+        session.send_update(key, frames)
+
+
+def status_message(key: ChannelKey, connected: bool) -> str:
+    provider, pv_name = key
+    return json.dumps(
+        {
+            "type": "status",
+            "pv": client_pv_name(pv_name, provider),
+            "status": "connected" if connected else "disconnected",
+        }
     )
 
-    if provider != DEFAULT_PROTOCOL:
-        pv_name_with_provider = f"{provider}://{pv_name}"
+
+def report_status(
+    session: ClientSession, key: ChannelKey, connected: bool, message: Optional[str] = None
+):
+    """
+    Send the connection state of a channel to a client, unless it is the state last reported to it:
+    a client subscribing while a connection change is handed to the loop is told on subscribe
+    already.
+    """
+    if session.channel_status.get(key) == connected:
+        return
+    session.channel_status[key] = connected
+    session.reset_filter(key)
+    session.send(message or status_message(key, connected))
+
+
+def send_status(key: ChannelKey, connected: bool):
+    """Send a channel connection change to all clients subscribed to the channel."""
+    subscribers = registry.subscribers(key)
+    if subscribers:
+        message = status_message(key, connected)
+        for session in subscribers:
+            report_status(session, key, connected, message)
+
+
+def check_connection(session: ClientSession, key: ChannelKey):
+    """Report a PV as disconnected to a client if its channel did not connect in time."""
+    client = clients.get(key[0])
+    if registry.is_subscribed(session, key) and client and not client.is_connected(key[1]):
+        report_status(session, key, False)
+
+
+def history_message(key: ChannelKey, msg: dict, binary: bool):
+    """
+    Recent samples of a PV as one message: time stamps (s since epoch) and values, float64 arrays.
+    Binary frames hold the time stamps followed by the values.
+    """
+    provider, pv_name = key
+    since = msg.get("since")
+    try:
+        since = float(since) if since is not None else None
+    except (TypeError, ValueError):
+        since = None
+    buffer = history.get(key)
+    if buffer is not None:
+        times, values = buffer.samples(since, parse_points(msg) or None)
     else:
-        pv_name_with_provider = pv_name
-
-    base_message = {
-        "type": "update",
-        "pv": pv_name_with_provider,
-        "value": pv_data.value,
-        "alarm": pv_data.alarm.__dict__ if pv_data.alarm else None,
-        "timeStamp": pv_data.timeStamp.__dict__ if pv_data.timeStamp else None,
-        "b64arr": pv_data.b64arr,
-        "b64dtype": pv_data.b64dtype,
-    }
+        times = values = np.empty(0, dtype=np.float64)
+
+    message = {"type": "history", "pv": client_pv_name(pv_name, provider), "count": times.size}
+    if binary and times.size:
+        message["dtype"] = "float64"
+        return encode_binary_message(message, times.tobytes() + values.tobytes())
+    if times.size:
+        message["b64times"] = encode_base64_array(times)
+        message["b64arr"] = encode_base64_array(values)
+        message["b64dtype"] = "float64"
+    return encode_message(message)
+
+
+async def read_pv(key: ChannelKey, timeout: float) -> Union[UpdateFrames, str]:
+    """
+    Current update of a PV: the latest one of its live subscription, else a one-shot read which
+    does not set up a monitor. Returns its frames, or the error.
+    """
+    frames = latest_frames.get(key)
+    if frames is not None:
+        return frames
+
+    provider, pv_name = key
+    try:
+        client = get_client(provider)
+        pv_obj = await asyncio.get_running_loop().run_in_executor(
+            pv_reader, client.get, pv_name, timeout
+        )
+        # already parsed by the upstream process in sharded mode
+        pv_data = pv_obj if isinstance(pv_obj, PVData) else parse_update(pv_name, pv_obj, provider)
+    except Exception as e:
+        return str(e) or type(e).__name__
+    return UpdateFrames(client_pv_name(pv_name, provider), pv_data, pv_obj)
+
+
+async def send_get_result(session: ClientSession, msg: dict):
+    """
+    Answer a get request: the current updates of all its PVs, metadata included, read concurrently
+    and sent as one getResult message. PVs which could not be read carry an error instead.
+    """
+    keys = list(dict.fromkeys(parse_protocol(pv) for pv in msg.get("pvs", [])))
+    timeout = parse_get_timeout(msg)
+    points = parse_points(msg)
+    dtype = parse_array_dtype(msg)
+    results = await asyncio.gather(*(read_pv(key, timeout) for key in keys))
+
+    entries = []
+    for (provider, pv_name), result in zip(keys, results):
+        if isinstance(result, str):
+            pv = client_pv_name(pv_name, provider)
+            entries.append(encode_message({"pv": pv, "error": result}))
+        else:
+            frames = result.decimated(points) if points else result
+            if dtype != NATIVE:
+                frames = frames.cast(dtype)
+            entries.append(frames.frame(with_metadata=True))
+    # entries are already encoded, possibly shared with subscribers: join, don't re-encode
+    session.send(
+        f'{{"type": "getResult", "id": {json.dumps(msg.get("id"))}, '
+        f'"results": [{", ".join(entries)}]}}'
+    )
 
-    for ws in set(subscriptions.get(pv_name, set())):
-        key = (ws, pv_name)
-        message = dict(base_message)
-        if not sent_metadata.get(key):
-            message.update(
-                {
-                    "enumChoices": pv_data.enumChoices,
-                    "display": pv_data.display.__dict__ if pv_data.display else None,
-                    "control": pv_data.control.__dict__ if pv_data.control else None,
-                    "valueAlarm": pv_data.valueAlarm.__dict__ if pv_data.valueAlarm else None,
-                }
-            )
-            sent_metadata[key] = True
-
-        data = json.dumps({k: v for k, v in message.items() if v is not None})
 
-        try:
-            await ws.send(data)
-        except Exception:
-            print(f"[epicsWS]: Error sending update to {ws}")
+def send_write_result(
+    session: ClientSession, pv: str, write_id, future: "asyncio.Future[WriteResult]"
+):
+    """Report the outcome of a write to the client that requested it."""
+    result: WriteResult = future.result()
+    if not result.success and not result.superseded:
+        print(f"[epicsWS]: Write to {pv} failed: {result.error}")
+    if write_id is None:
+        return
+    message = {
+        "type": "writeResult",
+        "id": write_id,
+        "pv": pv,
+        "success": result.success,
+        "latency": result.latency,
+        "error": result.error,
+        "superseded": result.superseded,
+    }
+    session.send(json.dumps(message))
 
 
 async def message_handler(ws: WebSocketServerProtocol):
     client_id = f"{ws.remote_address[0]}:{ws.remote_address[1]}"
     print(f"New connection from {client_id}")
     loop = asyncio.get_running_loop()
-
-    def ca_callback(pv_name, pv_obj):
-        asyncio.run_coroutine_threadsafe(send_update(pv_name, pv_obj, CA_PROVIDER_KEY), loop)
-
-    def pva_callback(pv_name, pv_obj):
-        asyncio.run_coroutine_threadsafe(send_update(pv_name, pv_obj, PVA_PROVIDER_KEY), loop)
-
-    def get_client(protocol: str):
-        if protocol == PVA_PROVIDER_KEY:
-            if clients[PVA_PROVIDER_KEY] is None:
-                clients[PVA_PROVIDER_KEY] = P4PClient(pva_callback)
-            return clients[PVA_PROVIDER_KEY]
-        elif protocol == CA_PROVIDER_KEY:
-            if clients[CA_PROVIDER_KEY] is None:
-                clients[CA_PROVIDER_KEY] = CaprotoClient(ca_callback)
-            return clients[CA_PROVIDER_KEY]
-        raise ValueError(f"[epicsWS]: Unsupported protocol: {protocol}")
+    session = ClientSession(ws, client_id, QUEUE_SIZE, QUEUE_POLICY, RESYNC_INTERVAL)
+    sessions[ws] = session
+    writer = asyncio.create_task(session.run())
+    gets: Set[asyncio.Task] = set()
 
     try:
         async for message in ws:
             msg = json.loads(message)
             msg_type = msg.get("type")
 
-            if msg_type == "subscribe":
+            if msg_type == "config":
+                session.binary = bool(msg.get("binaryArrays"))
+                session.delta = bool(msg.get("deltaUpdates"))
+                session.batch_interval = parse_batch_interval(msg)
+                session.send(
+                    json.dumps(
+                        {
+                            "type": "config",
+                            "binaryArrays": session.binary,
+                            "deltaUpdates": session.delta,
+                            "batchUpdates": session.batch_interval > 0,
+                            "batchInterval": session.batch_interval,
+                        }
+                    )
+                )
+
+            elif msg_type == "subscribe":
+                # providers connect channels in the background, so this never blocks on the
+                # network: connection states are reported progressively through status messages
+                rate = parse_rate(msg)
+                points = parse_points(msg)
+                dtype = parse_array_dtype(msg)
+                deadband = parse_deadband(msg)
                 for pv in msg.get("pvs", []):
-                    protocol, pv_name = parse_protocol(pv)
+                    key = parse_protocol(pv)
+                    protocol, pv_name = key
                     client = get_client(protocol)
 
-                    if pv_name not in subscriptions:
-                        subscriptions[pv_name] = set()
-                    subscriptions[pv_name].add(ws)
+                    add_subscriber(session, key, rate)
+                    if points:
+                        session.max_points[key] = points
+                    if dtype != NATIVE:
+                        session.array_dtypes[key] = dtype
+                    if deadband:
+                        session.filters[key] = DeadbandFilter(*deadband)
                     client.subscribe(client_id, pv_name)
+                    if client.is_connected(pv_name):
+                        report_status(session, key, True)
+                        cached = latest_frames.get(key)
+                        if cached is not None:
+                            # late joiner: send the last known value and metadata immediately
+                            session.send_update(key, cached)
+                    else:
+                        loop.call_later(CONNECT_TIMEOUT, check_connection, session, key)
 
             elif msg_type == "unsubscribe":
                 for pv in msg.get("pvs", []):
-                    protocol, pv_name = parse_protocol(pv)
-                    client = get_client(protocol)
+                    key = parse_protocol(pv)
+                    protocol, pv_name = key
+                    if remove_subscriber(session, key):
+                        session.forget(key)
+                        get_client(protocol).unsubscribe(client_id, pv_name)
+
+            elif msg_type == "resync":
+                # send the latest update of the PVs (all subscribed ones by default) in full
+                pvs = msg.get("pvs")
+                if pvs is not None:
+                    keys = [parse_protocol(pv) for pv in pvs]
+                else:
+                    keys = registry.channels(session)
+                for key in keys:
+                    if not registry.is_subscribed(session, key):
+                        continue
+                    session.resync(key)
+                    cached = latest_frames.get(key)
+                    if cached is not None:
+                        session.send_update(key, cached)
+
+            elif msg_type == "history":
+                for pv in msg.get("pvs", []):
+                    session.send(history_message(parse_protocol(pv), msg, session.binary))
 
-                    if pv_name in subscriptions:
-                        subscriptions[pv_name].discard(ws)
-                        if not subscriptions[pv_name]:
-                            del subscriptions[pv_name]
-                        client.unsubscribe(client_id, pv_name)
-                    sent_metadata.pop((ws, pv_name), None)
+            elif msg_type == "get":
+                task = asyncio.create_task(send_get_result(session, msg))
+                gets.add(task)
+                task.add_done_callback(gets.discard)
 
             elif msg_type == "write":
                 pv = msg.get("pv")
@@ -134,31 +709,254 @@ async def message_handler(ws: WebSocketServerProtocol):
                 if pv and value is not None:
                     protocol, pv_name = parse_protocol(pv)
                     client = get_client(protocol)
-                    client.write_to_pv(pv_name, value)
+                    write = pv_writer.write(
+                        (protocol, pv_name), partial(client.write_to_pv, pv_name, value)
+                    )
+                    write.add_done_callback(
+                        partial(send_write_result, session, pv, msg.get("id"))
+                    )
 
             else:
-                await ws.send(json.dumps({"type": "error", "message": "Unknown message type"}))
+                session.send(json.dumps({"type": "error", "message": "Unknown message type"}))
 
     except Exception as e:
         print(f"[epicsWS]: Error handling message from {client_id}: {e}")
 
     finally:
         print(f"[epicsWS]: Client disconnected: {client_id}")
-        for pv, clients_set in list(subscriptions.items()):
-            clients_set.discard(ws)
-            if not clients_set:
-                del subscriptions[pv]
-            sent_metadata.pop((ws, pv), None)
-        for c in clients.values():
-            if c:
-                c.unsubscribe_all(client_id)
-
-
-async def main():
-    async with websockets.serve(message_handler, "0.0.0.0", 8080):
-        print("[epicsWS]: WebSocket server running on ws://localhost:8080")
+        writer.cancel()
+        for task in gets:
+            task.cancel()
+        sessions.pop(ws, None)
+        # only this client's channels are visited: the session state itself is dropped as a whole
+        for protocol, pv_name in registry.channels(session):
+            remove_subscriber(session, (protocol, pv_name))
+            clients[protocol].unsubscribe(client_id, pv_name)
+
+
+def prewarm(pvs: List[str]):
+    """
+    Subscribe PVs before any client does, and keep them subscribed: their channels are connected and
+    their latest update is cached, sent right away to the clients subscribing to them. PVs that
+    fail (provider not available, invalid name) are reported and skipped.
+    """
+    count = 0
+    for pv in pvs:
+        key = parse_protocol(pv)
+        try:
+            client = get_client(key[0])
+            registry.add(prewarmer, key, PREWARM_RATE)
+            client.subscribe(PREWARM_ID, key[1])
+        except Exception as e:
+            print(f"[epicsWS]: Failed to pre-warm {pv}: {e!r}")
+            remove_subscriber(prewarmer, key)
+            continue
+        count += 1
+    print(f"[epicsWS]: Pre-warming {count} of {len(pvs)} PVs")
+
+
+def queue_stats() -> Dict[str, dict]:
+    """Outbound queue depth and dropped updates per connected client, for monitoring."""
+    return {s.client_id: {"depth": s.depth, "dropped": s.dropped} for s in sessions.values()}
+
+
+def handoff_stats() -> Dict[str, int]:
+    """Provider callbacks waiting for the event loop and loop wakeups used, for monitoring."""
+    return handoff.stats()
+
+
+def history_stats() -> dict:
+    """Number and memory of the PV history buffers, for monitoring."""
+    return history.stats()
+
+
+def linger_stats() -> Dict[str, dict]:
+    """Lingering channel cache size and hit/eviction counters per provider, for monitoring."""
+    if upstream_server is not None:
+        return upstream_server.linger_stats()
+    return {protocol: client.linger_stats() for protocol, client in clients.items() if client}
+
+
+def channel_stats() -> Dict[str, Dict[str, int]]:
+    """
+    Subscribed and connected channels per provider, for monitoring. Workers of the sharded mode
+    report the channels of their own clients, the upstream process all of them.
+    """
+    if upstream_server is not None:
+        return upstream_server.channel_stats()
+    stats = {protocol: {"subscribed": 0, "connected": 0} for protocol, c in clients.items() if c}
+    for protocol, pv_name in registry:
+        client = clients.get(protocol)
+        if client is None:
+            continue
+        stats[protocol]["subscribed"] += 1
+        stats[protocol]["connected"] += client.is_connected(pv_name)
+    return stats
+
+
+def register_metrics():
+    """Expose the monitoring stats of this process as metrics, read on each scrape."""
+    collector = metrics.registry.collector
+    collector(
+        "epicsws_clients", "Connected websocket clients", "gauge", (), lambda: [((), len(sessions))]
+    )
+    collector(
+        "epicsws_channels",
+        "Subscribed channels",
+        "gauge",
+        ("provider",),
+        lambda: [((p,), s["subscribed"]) for p, s in channel_stats().items()],
+    )
+    collector(
+        "epicsws_channels_connected",
+        "Connected subscribed channels",
+        "gauge",
+        ("provider",),
+        lambda: [((p,), s["connected"]) for p, s in channel_stats().items()],
+    )
+    collector(
+        "epicsws_client_queue_depth",
+        "Messages waiting to be sent to a client",
+        "gauge",
+        ("client",),
+        lambda: [((c,), s["depth"]) for c, s in queue_stats().items()],
+    )
+    collector(
+        "epicsws_client_dropped_total",
+        "Updates dropped by the slow-consumer policy",
+        "counter",
+        ("client",),
+        lambda: [((c,), s["dropped"]) for c, s in queue_stats().items()],
+    )
+    collector(
+        "epicsws_handoff_pending",
+        "Provider callbacks waiting for the event loop",
+        "gauge",
+        (),
+        lambda: [((), handoff_stats()["pending"])],
+    )
+    collector(
+        "epicsws_handoff_calls_total",
+        "Provider callbacks handed to the event loop",
+        "counter",
+        (),
+        lambda: [((), handoff_stats()["calls"])],
+    )
+    collector(
+        "epicsws_handoff_batches_total",
+        "Event loop wakeups running provider callbacks",
+        "counter",
+        (),
+        lambda: [((), handoff_stats()["batches"])],
+    )
+    collector(
+        "epicsws_handoff_max_batch",
+        "Largest number of provider callbacks run in one event loop wakeup",
+        "gauge",
+        (),
+        lambda: [((), handoff_stats()["maxBatch"])],
+    )
+    collector(
+        "epicsws_linger_channels",
+        "Lingering channels without subscribers",
+        "gauge",
+        ("provider",),
+        lambda: [((p,), s["size"]) for p, s in linger_stats().items() if s],
+    )
+    for field, help in (
+        ("hits", "Subscribes reusing a lingering channel"),
+        ("misses", "Subscribes opening a new channel"),
+        ("expired", "Lingering channels closed after the linger time"),
+        ("evicted", "Lingering channels closed because the linger cache was full"),
+    ):
+        collector(
+            f"epicsws_linger_{field}_total",
+            help,
+            "counter",
+            ("provider",),
+            lambda field=field: [((p,), s[field]) for p, s in linger_stats().items() if s],
+        )
+    collector(
+        "epicsws_history_bytes",
+        "Memory of the PV history buffers",
+        "gauge",
+        (),
+        lambda: [((), history_stats()["bytes"])],
+    )
+    collector(
+        "epicsws_history_evicted_total",
+        "PV history buffers dropped to stay under the memory cap",
+        "counter",
+        (),
+        lambda: [((), history_stats()["evicted"])],
+    )
+
+
+register_metrics()
+
+
+async def main(reuse_port: bool = False, metrics_port: int = METRICS_PORT):
+    handoff.bind(asyncio.get_running_loop())
+    if metrics_port:
+        await metrics.serve(METRICS_HOST, metrics_port)
+    if upstream is None and PREWARM_FILES:
+        # in sharded mode, the upstream process owns the channels and pre-warms them
+        prewarm(load_pv_names(PREWARM_FILES))
+    async with websockets.serve(message_handler, "0.0.0.0", 8080, reuse_port=reuse_port):
+        print(f"[epicsWS]: WebSocket server running on ws://localhost:8080 (pid {os.getpid()})")
         await asyncio.Future()
 
 
+async def run_worker_async(path: str, index: int):
+    global upstream
+    upstream = await UpstreamLink.connect(path)
+    metrics_port = METRICS_PORT + 1 + index if METRICS_PORT else 0
+    server = asyncio.create_task(main(reuse_port=True, metrics_port=metrics_port))
+    # a worker is useless without the upstream process: stop with it
+    await upstream.wait_closed()
+    server.cancel()
+
+
+def run_worker(path: str, index: int):
+    """Entry point of a websocket worker process of the sharded mode."""
+    asyncio.run(run_worker_async(path, index))
+
+
+async def run_sharded(workers: int):
+    """
+    Sharded mode: this process owns the provider channels and serves parsed updates to websocket
+    worker processes, which share the websocket port (SO_REUSEPORT) and do the encoding and I/O.
+    """
+    global upstream_server
+    server = UpstreamServer(IPC_PATH, create_client, parse_update, parse_metadata, metadata_changed)
+    upstream_server = server
+    await server.start()
+    if PREWARM_FILES:
+        pvs = load_pv_names(PREWARM_FILES)
+        count = server.prewarm([parse_protocol(pv) for pv in pvs], PREWARM_RATE)
+        print(f"[epicsWS]: Pre-warming {count} of {len(pvs)} PVs")
+    if METRICS_PORT:
+        await metrics.serve(METRICS_HOST, METRICS_PORT)
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=run_worker, args=(IPC_PATH, i), name=f"epicsWS-worker-{i}")
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    print(f"[epicsWS]: Upstream process running with {workers} websocket workers")
+    # stop on SIGTERM (docker stop, systemd) like on Ctrl-C, so the cleanup below runs and the IPC
+    # socket is removed
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    try:
+        await asyncio.Future()
+    except asyncio.CancelledError:
+        print("[epicsWS]: Stopping")
+    finally:
+        for process in processes:
+            process.terminate()
+        server.close()
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    asyncio.run(run_sharded(WORKERS) if WORKERS > 1 else main())
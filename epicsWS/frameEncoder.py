@@ -0,0 +1,176 @@
+import dataclasses
+import json
+import struct
+import time
+from typing import Any, Dict, Hashable, Optional, Union
+
+import metrics
+from pvParser import PVData, decimate_minmax, encode_base64_array, to_wire_array
+
+# binary frames start with the header length, followed by the JSON header and the raw array.
+# The header is space-padded so the array starts at a multiple of 8 bytes, allowing clients to wrap
+# it into a typed array without copying
+BINARY_HEADER_PREFIX = struct.Struct("<I")
+BINARY_ALIGNMENT = 8
+
+# wire dtypes of array updates requested by clients: as parsed, narrowed or widened
+NATIVE = "native"
+FLOAT32 = "float32"
+FLOAT64 = "float64"
+ARRAY_DTYPES = (NATIVE, FLOAT32, FLOAT64)
+
+
+def encode_message(message: dict) -> str:
+    """JSON-encode a message, dropping fields that are None."""
+    return json.dumps({k: v for k, v in message.items() if v is not None})
+
+
+def encode_binary_message(message: dict, array: bytes) -> bytes:
+    """Pack a message header and a raw array payload into a binary frame."""
+    header = encode_message(message).encode("utf-8")
+    offset = BINARY_HEADER_PREFIX.size + len(header)
+    header += b" " * (-offset % BINARY_ALIGNMENT)
+    return b"".join([BINARY_HEADER_PREFIX.pack(len(header)), header, array])
+
+
+class UpdateFrames:
+    """
+    Wire frames of a single PV update, shared by every client receiving it.
+    Each variant (value-only or with metadata, JSON or binary, full or delta) is encoded at most
+    once, on first use. So are decimated versions of array updates, one per requested resolution.
+    """
+
+    def __init__(self, pv: str, pv_data: PVData, source: Optional[Any] = None):
+        """
+        pv: PV name as seen by the clients (with provider prefix if not the default one)
+        pv_data: parsed update
+        source: raw provider object the update was parsed from, used to detect stale frames
+        """
+        self.pv = pv
+        self.pv_data = pv_data
+        self.source = source
+        self._frames: Dict[Hashable, Union[str, bytes]] = {}
+        self._fragments: Optional[Dict[str, str]] = None
+        self._decimated: Dict[int, "UpdateFrames"] = {}
+        self._cast: Dict[str, "UpdateFrames"] = {}
+        self.created = time.perf_counter()  # when the update was parsed
+        self.decimated_from: Optional[int] = None  # original array length of decimated frames
+
+    @property
+    def has_array(self) -> bool:
+        """Whether the update carries a numeric array that can be sent as a binary frame."""
+        return self.pv_data.array is not None
+
+    def _fields(self) -> Dict[str, Any]:
+        """Per-update fields of the message, compared field by field for delta frames."""
+        pv_data = self.pv_data
+        return {
+            "value": pv_data.value,
+            "alarm": pv_data.alarm.__dict__ if pv_data.alarm else None,
+            "timeStamp": pv_data.timeStamp.__dict__ if pv_data.timeStamp else None,
+        }
+
+    def fragments(self) -> Dict[str, str]:
+        """JSON encoding of each per-update field, used to tell which fields changed."""
+        if self._fragments is None:
+            self._fragments = {k: json.dumps(v) for k, v in self._fields().items()}
+        return self._fragments
+
+    def _message(self, with_metadata: bool) -> dict:
+        message = {"type": "update", "pv": self.pv, **self._fields()}
+        if with_metadata and self.pv_data.metadata:
+            message.update(self.pv_data.metadata.to_dict())
+        return message
+
+    def decimated(self, points: int) -> "UpdateFrames":
+        """
+        Frames of the update with its array reduced to at most `points` values by min/max
+        decimation. Returns self for updates without an array, or with a short enough one.
+        """
+        array = self.pv_data.array
+        if array is None or array.size <= points:
+            return self
+
+        frames = self._decimated.get(points)
+        if frames is None:
+            pv_data = dataclasses.replace(self.pv_data, array=decimate_minmax(array, points))
+            frames = self._decimated[points] = UpdateFrames(self.pv, pv_data, self.source)
+            frames.decimated_from = array.size
+            frames.created = self.created
+        return frames
+
+    def cast(self, dtype: str) -> "UpdateFrames":
+        """
+        Frames of the update with its array sent in another wire dtype: float32 narrows float
+        arrays only (halving float64 payloads), float64 widens all numeric arrays. Returns self
+        for updates without an array, or already in that dtype.
+        """
+        array = self.pv_data.array
+        if (
+            array is None
+            or array.dtype.name == dtype
+            or (dtype == FLOAT32 and array.dtype.kind != "f")
+        ):
+            return self
+
+        frames = self._cast.get(dtype)
+        if frames is None:
+            pv_data = dataclasses.replace(self.pv_data, array=to_wire_array(array, dtype))
+            frames = self._cast[dtype] = UpdateFrames(self.pv, pv_data, self.source)
+            frames.decimated_from = self.decimated_from
+            frames.created = self.created
+        return frames
+
+    def _encode(self, message: dict, binary: bool) -> Union[str, bytes]:
+        """Encode a message, adding the array payload of the update."""
+        start = time.perf_counter()
+        array = self.pv_data.array
+        message["decimatedFrom"] = self.decimated_from
+        if binary:
+            message["dtype"] = array.dtype.name
+            frame = encode_binary_message(message, array.tobytes())
+        else:
+            if array is not None:
+                message["b64arr"] = encode_base64_array(array)
+                message["b64dtype"] = array.dtype.name
+            frame = encode_message(message)
+        metrics.encode_seconds.observe(
+            time.perf_counter() - start, ("binary",) if binary else ("json",)
+        )
+        return frame
+
+    def frame(self, with_metadata: bool = False, binary: bool = False) -> Union[str, bytes]:
+        """
+        Return the encoded frame, with or without the metadata fields.
+        Binary frames are only produced for array updates, other updates fall back to JSON.
+        """
+        binary = binary and self.has_array
+        key = (with_metadata, binary)
+        frame = self._frames.get(key)
+        if frame is None:
+            frame = self._frames[key] = self._encode(self._message(with_metadata), binary)
+        return frame
+
+    def delta_frame(
+        self, previous: "UpdateFrames", binary: bool = False
+    ) -> Optional[Union[str, bytes]]:
+        """
+        Return a frame holding only the fields that differ from `previous`, the last update the
+        client received; missing fields are unchanged. Array payloads are always sent.
+        Returns None if nothing changed.
+        """
+        binary = binary and self.has_array
+        fragments = self.fragments()
+        previous_fragments = previous.fragments()
+        changed = tuple(k for k, v in fragments.items() if previous_fragments.get(k) != v)
+        if not changed and not self.has_array:
+            return None
+
+        # frames only depend on the set of changed fields: clients in the same state share them
+        key = ("delta", changed, binary)
+        frame = self._frames.get(key)
+        if frame is None:
+            fields = self._fields()
+            message = {"type": "update", "pv": self.pv, **{k: fields[k] for k in changed}}
+            frame = self._frames[key] = self._encode(message, binary)
+        return frame
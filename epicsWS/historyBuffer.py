@@ -0,0 +1,103 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+
+import numpy as np
+
+from pvParser import PVData
+
+# bytes per sample: float64 time stamp and float64 value
+SAMPLE_SIZE = 16
+
+
+class HistoryBuffer:
+    """Fixed-size ring buffer of the latest (time stamp, value) samples of a scalar PV."""
+
+    def __init__(self, depth: int):
+        self._times = np.empty(depth, dtype=np.float64)
+        self._values = np.empty(depth, dtype=np.float64)
+        self._next = 0  # slot of the next sample
+        self._count = 0
+
+    def append(self, timestamp: float, value: float):
+        self._times[self._next] = timestamp
+        self._values[self._next] = value
+        self._next = (self._next + 1) % self._times.size
+        self._count = min(self._count + 1, self._times.size)
+
+    def samples(
+        self, since: Optional[float] = None, max_points: Optional[int] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Copy of the samples in chronological order: time stamps (s since epoch) and values.
+        since: only samples strictly after this time stamp
+        max_points: only the latest samples, at most this many
+        """
+        start = (self._next - self._count) % self._times.size
+        order = (start + np.arange(self._count)) % self._times.size
+        times, values = self._times[order], self._values[order]
+        if since is not None:
+            first = np.searchsorted(times, since, side="right")
+            times, values = times[first:], values[first:]
+        if max_points is not None and max_points < times.size:
+            times, values = times[-max_points:], values[-max_points:]
+        return times, values
+
+
+class HistoryStore:
+    """
+    History buffers of scalar numeric PVs, recorded from every update the providers deliver,
+    before rate throttling.
+    Buffers outlive subscriptions, so reopened screens find their trends, and the least recently
+    used ones are evicted to stay under the memory cap.
+    Must be used from within the asyncio event loop.
+    """
+
+    def __init__(self, depth: int, max_bytes: int):
+        """
+        depth: samples kept per PV, <= 0 disables the history
+        max_bytes: memory cap of all buffers
+        """
+        self.depth = depth
+        self._max_buffers = max_bytes // (depth * SAMPLE_SIZE) if depth > 0 else 0
+        self._buffers: "OrderedDict[Hashable, HistoryBuffer]" = OrderedDict()
+        self.evicted = 0  # buffers dropped because of the memory cap
+
+    @property
+    def enabled(self) -> bool:
+        return self._max_buffers > 0
+
+    def record(self, key: Hashable, pv_data: PVData):
+        """Append a parsed update to the history of a PV, if it is a scalar number."""
+        ts = pv_data.timeStamp
+        timestamp = ts.secondsPastEpoch + ts.nanoseconds * 1e-9 if ts else 0.0
+        self.record_sample(key, timestamp, pv_data.value)
+
+    def record_sample(self, key: Hashable, timestamp: float, value: Any):
+        """
+        Append a sample to the history of a PV, if the value is a scalar number. A time stamp of 0
+        (unset) is replaced by the current time.
+        """
+        if not self.enabled or isinstance(value, bool) or not isinstance(value, (int, float)):
+            return
+        buffer = self._buffers.get(key)
+        if buffer is None:
+            buffer = self._buffers[key] = HistoryBuffer(self.depth)
+            while len(self._buffers) > self._max_buffers:
+                self._buffers.popitem(last=False)
+                self.evicted += 1
+        else:
+            self._buffers.move_to_end(key)
+        buffer.append(timestamp or time.time(), value)
+
+    def get(self, key: Hashable) -> Optional[HistoryBuffer]:
+        return self._buffers.get(key)
+
+    def stats(self) -> dict:
+        """Number of buffers, their memory and evictions."""
+        size = len(self._buffers)
+        return {
+            "buffers": size,
+            "bytes": size * self.depth * SAMPLE_SIZE,
+            "evicted": self.evicted,
+        }
@@ -0,0 +1,123 @@
+import asyncio
+import pickle
+import struct
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Dict, Optional, Tuple, Union
+
+import numpy as np
+
+# IPC frames between the upstream process and the websocket workers: message length + pickle.
+# Both ends are processes of the same server, so pickle is trusted here
+FRAME_PREFIX = struct.Struct("<I")
+
+# arrays from this size (bytes) are passed through shared memory instead of the IPC stream
+SHARED_ARRAY_THRESHOLD = 4096
+
+# shared array segments start with a sequence number, odd while the array is being written
+SEQ = struct.Struct("<Q")
+SEQ_SIZE = 8
+
+# reference to an array in shared memory: (segment name, sequence number, dtype, length)
+SharedArrayRef = Tuple[str, int, str, int]
+
+
+async def read_message(reader: asyncio.StreamReader) -> Any:
+    """Read one message. Raises asyncio.IncompleteReadError once the peer is gone."""
+    (length,) = FRAME_PREFIX.unpack(await reader.readexactly(FRAME_PREFIX.size))
+    return pickle.loads(await reader.readexactly(length))
+
+
+def encode_message(message: Any) -> bytes:
+    """Encode a message as an IPC frame, to be written to one or more streams."""
+    payload = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    return FRAME_PREFIX.pack(len(payload)) + payload
+
+
+def attach_shared_memory(name: str) -> SharedMemory:
+    """
+    Open an existing segment without registering it for cleanup: its creator unlinks it.
+    Before Python 3.13 the segment is registered again, which is harmless since the workers are
+    spawned by the upstream process and share its resource tracker.
+    """
+    try:
+        return SharedMemory(name, track=False)  # Python >= 3.13
+    except TypeError:
+        return SharedMemory(name)
+
+
+class SharedArrayWriter:
+    """
+    Shared memory slot holding the latest array of a PV, written by the upstream process.
+    Readers copy the array out and check the sequence number (seqlock) to detect arrays overwritten
+    while being read. The segment is replaced by a larger one when an array does not fit.
+    """
+
+    def __init__(self):
+        self._shm: Optional[SharedMemory] = None
+        self._seq = 0
+
+    def write(self, array: np.ndarray) -> Union[SharedArrayRef, np.ndarray]:
+        """Store an array, returning the reference to send, or the array itself if small."""
+        if array.nbytes < SHARED_ARRAY_THRESHOLD:
+            return array
+
+        if self._shm is None or self._shm.size < SEQ_SIZE + array.nbytes:
+            self.close()
+            self._shm = SharedMemory(create=True, size=SEQ_SIZE + array.nbytes * 3 // 2)
+            self._seq = 0
+
+        buf = self._shm.buf
+        SEQ.pack_into(buf, 0, self._seq + 1)
+        buf[SEQ_SIZE : SEQ_SIZE + array.nbytes] = memoryview(np.ascontiguousarray(array)).cast("B")
+        self._seq += 2
+        SEQ.pack_into(buf, 0, self._seq)
+        return (self._shm.name, self._seq, array.dtype.str, array.size)
+
+    def close(self):
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+
+class SharedArrayReader:
+    """Reads arrays referenced by IPC messages, keeping one segment attached per PV."""
+
+    def __init__(self):
+        self._segments: Dict[Any, SharedMemory] = {}
+
+    def read(
+        self, key: Any, ref: Union[SharedArrayRef, np.ndarray, None]
+    ) -> Optional[np.ndarray]:
+        """
+        Return a copy of the referenced array, or None if it was already overwritten by a newer
+        one, whose own message follows.
+        """
+        if ref is None or isinstance(ref, np.ndarray):
+            return ref
+
+        name, seq, dtype, size = ref
+        shm = self._segments.get(key)
+        if shm is None or shm.name != name:
+            self.forget(key)
+            try:
+                shm = self._segments[key] = attach_shared_memory(name)
+            except FileNotFoundError:
+                return None
+
+        buf = shm.buf
+        if SEQ.unpack_from(buf, 0)[0] != seq:
+            return None
+        array = np.frombuffer(buf, dtype=dtype, count=size, offset=SEQ_SIZE).copy()
+        if SEQ.unpack_from(buf, 0)[0] != seq:
+            return None
+        return array
+
+    def forget(self, key: Any):
+        shm = self._segments.pop(key, None)
+        if shm is not None:
+            shm.close()
+
+    def close(self):
+        for key in list(self._segments):
+            self.forget(key)
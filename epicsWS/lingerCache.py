@@ -0,0 +1,104 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+
+class LingerCache:
+    """
+    LRU of upstream channels released by their last subscriber. Released channels are kept open for
+    a grace period so that re-subscribing is instant; they are closed through the `close` callback
+    when the grace period expires or when the cache exceeds its max size.
+    The cache only tracks channel names, the providers own the channels themselves.
+    """
+
+    def __init__(self, close: Callable[[str], None], grace: float = 30.0, max_size: int = 1000):
+        """
+        close: callable(name: str), closes a channel. Called without holding the cache lock
+        grace: seconds a released channel is kept open, <= 0 closes channels right away
+        max_size: max number of released channels kept open
+        """
+        self._close = close
+        self._grace = grace
+        self._max_size = max_size
+        self._released: "OrderedDict[str, float]" = OrderedDict()  # name -> release time
+        self._lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+        self.hits = 0  # subscriptions served by a lingering channel
+        self.misses = 0  # subscriptions that had to open a new channel
+        self.expired = 0  # channels closed at the end of their grace period
+        self.evicted = 0  # channels closed early because the cache was full
+
+    def release(self, name: str):
+        """Start the grace period of a channel that lost its last subscriber."""
+        if self._grace <= 0 or self._max_size <= 0:
+            self._close(name)
+            return
+
+        evicted: List[str] = []
+        with self._lock:
+            self._released[name] = time.monotonic()
+            self._released.move_to_end(name)
+            while len(self._released) > self._max_size:
+                evicted.append(self._released.popitem(last=False)[0])
+                self.evicted += 1
+            if self._timer is None:
+                self._schedule(self._grace)
+
+        for evicted_name in evicted:
+            self._close(evicted_name)
+
+    def revive(self, name: str) -> bool:
+        """Take a channel back out of the cache on subscribe. Returns whether it was lingering."""
+        with self._lock:
+            hit = self._released.pop(name, None) is not None
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return hit
+
+    def _schedule(self, delay: float):
+        """Arm the expiry timer. Must be called with the lock held."""
+        self._timer = threading.Timer(delay, self._sweep)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _sweep(self):
+        """Close channels whose grace period is over and re-arm for the next one."""
+        now = time.monotonic()
+        expired: List[str] = []
+        with self._lock:
+            self._timer = None
+            while self._released:
+                name, released_at = next(iter(self._released.items()))
+                if now - released_at < self._grace:
+                    self._schedule(released_at + self._grace - now)
+                    break
+                self._released.popitem(last=False)
+                expired.append(name)
+                self.expired += 1
+
+        for name in expired:
+            self._close(name)
+
+    def clear(self) -> List[str]:
+        """Stop tracking all channels, returning their names. The caller closes them."""
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            names = list(self._released)
+            self._released.clear()
+        return names
+
+    def stats(self) -> Dict[str, int]:
+        """Cache size and eviction counters."""
+        with self._lock:
+            return {
+                "size": len(self._released),
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "evicted": self.evicted,
+            }
@@ -0,0 +1,223 @@
+"""
+Load generator for the gateway: opens N websocket clients subscribing M PVs each, and reports the
+end-to-end latency percentiles (update time stamp to reception), the frame and update rates, and
+the CPU and memory used by the gateway processes.
+
+Simulated PVs make the runs reproducible without IOCs, e.g. 50 clients sharing 200 sine waveforms
+of 1000 points at 10 Hz:
+
+    python loadTest.py --clients 50 --pvs 200 --size 1000 --rate 10 --pid $(pgrep -of epicsWS.py)
+
+Latencies compare the time stamps set by the gateway (or the IOCs) to the clock of this process,
+so they are only meaningful on the same host or with synchronized clocks.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import struct
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+import websockets
+
+PV_TEMPLATE = "sim://{shape}:{index}?rate={rate}&size={size}"
+
+
+class ClientStats:
+    """Frames, updates and latencies received by one client."""
+
+    def __init__(self):
+        self.frames = 0
+        self.updates = 0
+        self.bytes = 0
+        self.latencies: List[float] = []
+
+    def record(self, message: dict, received: float):
+        timestamp = message.get("timeStamp")
+        if message.get("type") != "update" or not timestamp:
+            return
+        self.updates += 1
+        sent = timestamp["secondsPastEpoch"] + timestamp["nanoseconds"] * 1e-9
+        if sent > 0:
+            self.latencies.append(received - sent)
+
+
+def decode_frame(frame) -> dict:
+    """JSON message or header of a binary frame."""
+    if isinstance(frame, bytes):
+        header_length = struct.unpack_from("<I", frame)[0]
+        return json.loads(frame[4 : 4 + header_length])
+    return json.loads(frame)
+
+
+async def run_client(args, pvs: List[str], stats: ClientStats, measuring: asyncio.Event):
+    async with websockets.connect(args.url, max_size=None) as ws:
+        await ws.send(
+            json.dumps(
+                {
+                    "type": "config",
+                    "binaryArrays": args.binary,
+                    "batchUpdates": args.batch,
+                }
+            )
+        )
+        await ws.send(json.dumps({"type": "subscribe", "pvs": pvs, "maxRate": args.max_rate}))
+        async for frame in ws:
+            if not measuring.is_set():
+                continue
+            received = time.time()
+            stats.frames += 1
+            stats.bytes += len(frame)
+            message = decode_frame(frame)
+            for entry in message.get("updates", [message]):
+                stats.record(entry, received)
+
+
+def process_tree(pid: int) -> List[int]:
+    """A process and its descendants (Linux), e.g. the workers of the sharded mode."""
+    pids = [pid]
+    for tid in os.listdir(f"/proc/{pid}/task"):
+        try:
+            with open(f"/proc/{pid}/task/{tid}/children") as f:
+                children = [int(child) for child in f.read().split()]
+        except OSError:
+            continue
+        for child in children:
+            pids.extend(process_tree(child))
+    return pids
+
+
+def process_usage(pids: List[int]) -> Dict[str, float]:
+    """CPU time (s) and resident memory (MiB) of processes, from /proc (Linux)."""
+    cpu = rss = 0.0
+    ticks = os.sysconf("SC_CLK_TCK")
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                # the command name may hold spaces: the fields follow its closing parenthesis
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{pid}/statm") as f:
+                resident = int(f.read().split()[1])
+        except OSError:
+            continue
+        cpu += (int(fields[11]) + int(fields[12])) / ticks  # utime + stime
+        rss += resident * page_size / 2**20
+    return {"cpu": cpu, "rss": rss}
+
+
+def gateway_usage(pid: Optional[int]) -> Optional[Dict[str, float]]:
+    return process_usage(process_tree(pid)) if pid else None
+
+
+def report(args, stats: List[ClientStats], duration: float, usage: Optional[dict]) -> dict:
+    latencies = np.array([latency for s in stats for latency in s.latencies]) * 1000
+    results = {
+        "clients": args.clients,
+        "pvsPerClient": args.pvs,
+        "duration": round(duration, 3),
+        "framesPerSecond": round(sum(s.frames for s in stats) / duration, 1),
+        "updatesPerSecond": round(sum(s.updates for s in stats) / duration, 1),
+        "megabytesPerSecond": round(sum(s.bytes for s in stats) / duration / 2**20, 3),
+        "idleClients": sum(1 for s in stats if not s.frames),
+    }
+    if latencies.size:
+        percentiles = np.percentile(latencies, [50, 90, 99, 99.9])
+        results["latencyMs"] = {
+            "p50": round(float(percentiles[0]), 3),
+            "p90": round(float(percentiles[1]), 3),
+            "p99": round(float(percentiles[2]), 3),
+            "p99.9": round(float(percentiles[3]), 3),
+            "max": round(float(latencies.max()), 3),
+        }
+    if usage:
+        results["gateway"] = usage
+    return results
+
+
+async def main(args):
+    if args.pv_list:
+        with open(args.pv_list) as f:
+            names = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    else:
+        count = args.pvs if args.shared else args.pvs * args.clients
+        names = [
+            args.template.format(shape=args.shape, index=i, rate=args.rate, size=args.size)
+            for i in range(count)
+        ]
+    if args.shared:
+        client_pvs = [names[: args.pvs]] * args.clients
+    else:
+        client_pvs = [names[i * args.pvs : (i + 1) * args.pvs] for i in range(args.clients)]
+
+    stats = [ClientStats() for _ in range(args.clients)]
+    measuring = asyncio.Event()
+    tasks = [
+        asyncio.create_task(run_client(args, pvs, client_stats, measuring))
+        for pvs, client_stats in zip(client_pvs, stats)
+    ]
+    await asyncio.sleep(args.warmup)
+
+    start_usage = gateway_usage(args.pid)
+    start = time.time()
+    measuring.set()
+    await asyncio.sleep(args.duration)
+    measuring.clear()
+    duration = time.time() - start
+    end_usage = gateway_usage(args.pid)
+
+    for task in tasks:
+        task.cancel()
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    failed = [e for e in results if isinstance(e, Exception)]
+    for error in failed[:5]:
+        print(f"[loadTest]: Client failed: {error!r}")
+
+    usage = None
+    if start_usage and end_usage:
+        usage = {
+            "cpuPercent": round((end_usage["cpu"] - start_usage["cpu"]) / duration * 100, 1),
+            "rssMiB": round(end_usage["rss"], 1),
+        }
+    return report(args, stats, duration, usage)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--url", default="ws://localhost:8080", help="gateway websocket URL")
+    parser.add_argument("--clients", type=int, default=10, help="websocket clients (N)")
+    parser.add_argument("--pvs", type=int, default=100, help="PVs subscribed per client (M)")
+    parser.add_argument(
+        "--shared",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="all clients subscribe the same PVs, else each client its own ones",
+    )
+    parser.add_argument("--shape", default="sine", help="shape of the simulated PVs")
+    parser.add_argument("--rate", type=float, default=10, help="update rate of simulated PVs (Hz)")
+    parser.add_argument("--size", type=int, default=1, help="elements of simulated PVs")
+    parser.add_argument("--template", default=PV_TEMPLATE, help="PV name template")
+    parser.add_argument("--pv-list", help="file of PV names, one per line, instead of the template")
+    parser.add_argument(
+        "--max-rate", type=float, default=0, help="max update rate per subscription (0: no limit)"
+    )
+    parser.add_argument("--binary", action="store_true", help="request binary array frames")
+    parser.add_argument("--batch", action="store_true", help="request batched update messages")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds before measuring")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of measurement")
+    parser.add_argument("--pid", type=int, help="gateway process id, to report its CPU and RSS")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON only")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = asyncio.run(main(args))
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for name, value in results.items():
+            print(f"{name}: {value}")
@@ -0,0 +1,58 @@
+import asyncio
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+class LoopHandoff:
+    """
+    Hands calls from provider callback threads over to the asyncio event loop in batches.
+    Calls are appended to a locked list and a single drain is scheduled on the loop for all the
+    calls queued until it runs, instead of one loop wakeup per call.
+    """
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self._loop = loop
+        self._lock = threading.Lock()
+        self._calls: List[Tuple[Callable[..., None], tuple]] = []
+        self._scheduled = False
+        self._batches = 0
+        self._handed_off = 0
+        self._max_batch = 0
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        """Set the event loop running the calls, before the first push."""
+        self._loop = loop
+
+    def push(self, callback: Callable[..., None], *args: Any):
+        """Queue callback(*args) to run on the event loop. Thread-safe."""
+        with self._lock:
+            self._calls.append((callback, args))
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self._loop.call_soon_threadsafe(self._drain)
+
+    def _drain(self):
+        with self._lock:
+            calls, self._calls = self._calls, []
+            self._scheduled = False
+        self._batches += 1
+        self._handed_off += len(calls)
+        self._max_batch = max(self._max_batch, len(calls))
+        for callback, args in calls:
+            try:
+                callback(*args)
+            except Exception as e:
+                # one failing call must not drop the rest of the batch
+                self._loop.call_exception_handler(
+                    {"message": f"Exception in {callback.__name__}", "exception": e}
+                )
+
+    def stats(self) -> Dict[str, int]:
+        """Pending calls, and calls and loop wakeups (batches) handed off so far."""
+        return {
+            "pending": len(self._calls),
+            "calls": self._handed_off,
+            "batches": self._batches,
+            "maxBatch": self._max_batch,
+        }
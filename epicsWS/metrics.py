@@ -0,0 +1,235 @@
+import abc
+import asyncio
+import os
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from subscriptionRegistry import ChannelKey
+
+# label channel metrics with the PV name too, not only the provider. One series per PV: only for
+# gateways serving a bounded set of PVs
+PER_PV = os.getenv("EPICS_WS_METRICS_PER_PV", "0") != "0"
+
+# upper bounds (s) of the buckets of the timing histograms
+TIME_BUCKETS = (1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+Labels = Tuple[str, ...]
+
+
+def _labels(names: Tuple[str, ...], values: Labels, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(abc.ABC):
+    """Base of the metrics: name, help text, type and label names, rendered in text format."""
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+
+    @abc.abstractmethod
+    def samples(self) -> Iterable[str]:
+        """Sample lines of the metric, without the HELP and TYPE header."""
+
+    def render(self) -> str:
+        header = f"# HELP {self.name} {self.help}\n# TYPE {self.name} {self.type}\n"
+        return header + "".join(f"{sample}\n" for sample in self.samples())
+
+
+class Counter(Metric):
+    """Monotonic counter per label values. Not thread-safe: use from the event loop."""
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, labels: Labels = (), amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in list(self._values.items()):
+            yield f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values per label values, in fixed buckets.
+    Observing costs a bisection and two additions. Not thread-safe: use from the event loop.
+    """
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = TIME_BUCKETS,
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = buckets
+        # label values -> [count per bucket (last one +Inf)..., sum]
+        self._values: Dict[Labels, List[float]] = {}
+
+    def observe(self, value: float, labels: Labels = ()):
+        counts = self._values.get(labels)
+        if counts is None:
+            counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self) -> Iterable[str]:
+        for labels, counts in list(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound}"'
+                yield f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(counts[-1])}"
+            yield f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}"
+
+
+class Collector(Metric):
+    """Gauge or counter read at scrape time from a function returning (label values, value)."""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        type: str,
+        labelnames: Tuple[str, ...],
+        collect: Callable[[], Iterable[Tuple[Labels, float]]],
+    ):
+        super().__init__(name, help, labelnames)
+        self.type = type
+        self._collect = collect
+
+    def samples(self) -> Iterable[str]:
+        for labels, value in self._collect():
+            yield f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+
+
+class MetricsRegistry:
+    """Metrics of the process, rendered in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"[metrics]: Duplicate metric {metric.name}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Tuple[str, ...] = ()) -> Histogram:
+        return self.register(Histogram(name, help, labelnames))
+
+    def collector(
+        self,
+        name: str,
+        help: str,
+        type: str,
+        labelnames: Tuple[str, ...],
+        collect: Callable[[], Iterable[Tuple[Labels, float]]],
+    ) -> Collector:
+        return self.register(Collector(name, help, type, labelnames, collect))
+
+    def render(self) -> str:
+        return "".join(metric.render() for metric in self._metrics.values())
+
+
+registry = MetricsRegistry()
+
+CHANNEL_LABELS = ("provider", "pv") if PER_PV else ("provider",)
+
+updates_in = registry.counter(
+    "epicsws_updates_in_total", "Monitor updates received from the providers", CHANNEL_LABELS
+)
+updates_out = registry.counter(
+    "epicsws_updates_out_total", "Updates sent to websocket clients", CHANNEL_LABELS
+)
+parse_seconds = registry.histogram(
+    "epicsws_parse_seconds", "Time parsing a monitor update", ("provider",)
+)
+encode_seconds = registry.histogram(
+    "epicsws_encode_seconds", "Time encoding an update frame, once per variant", ("format",)
+)
+update_latency_seconds = registry.histogram(
+    "epicsws_update_latency_seconds",
+    "Time from parsing an update to handing it to a client socket: throttling and queueing",
+)
+send_seconds = registry.histogram(
+    "epicsws_send_seconds", "Time writing a frame to a client socket, including backpressure"
+)
+loop_lag_seconds = registry.histogram(
+    "epicsws_loop_lag_seconds", "Delay of the event loop in running a scheduled callback"
+)
+
+
+_lag_monitor: Optional[asyncio.Task] = None
+
+
+def channel_labels(key: ChannelKey) -> Labels:
+    """Labels of the channel metrics of a (provider, pv) channel."""
+    return key if PER_PV else key[:1]
+
+
+async def monitor_loop_lag(interval: float = 0.25):
+    """Measure how late the event loop wakes up from a sleep, every interval seconds."""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        loop_lag_seconds.observe(max(loop.time() - expected, 0.0))
+
+
+async def _handle_scrape(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request = await reader.readuntil(b"\r\n\r\n")
+        path = request.split(b" ", 2)[1] if request.count(b" ") >= 2 else b""
+        if path.split(b"?")[0] in (b"/", b"/metrics"):
+            status, body = "200 OK", registry.render().encode()
+        else:
+            status, body = "404 Not Found", b"Not found\n"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+            + body
+        )
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host: str, port: int) -> Optional[asyncio.AbstractServer]:
+    """Serve the metrics over HTTP on /metrics, and start measuring the event loop lag."""
+    try:
+        server = await asyncio.start_server(_handle_scrape, host, port)
+    except OSError as e:
+        print(f"[metrics]: Failed to serve metrics on {host}:{port}: {e}")
+        return None
+    global _lag_monitor
+    _lag_monitor = asyncio.create_task(monitor_loop_lag())
+    print(f"[metrics]: Serving metrics on http://{host}:{port}/metrics")
+    return server
@@ -1,86 +1,263 @@
-from typing import Callable, Dict, Set, Any
-from p4p.client.thread import Context
+from typing import Callable, Dict, FrozenSet, List, Set, Any, Optional
+from p4p.client.thread import Context, Disconnected, Cancelled
 from p4p.client.thread import Subscription
 import threading
 
+from lingerCache import LingerCache
+
+# fields of the narrowed monitor of a PV, and of its metadata monitor. Servers send the metadata
+# in full on connection, then only when it changes
+DATA_FIELDS = "value,alarm,timeStamp"
+METADATA_FIELDS: FrozenSet[str] = frozenset(["display", "control", "valueAlarm"])
+
+
+def monitor_request(fields: str = "", queue_size: int = 0, pipeline: bool = False) -> str:
+    """pvRequest of a monitor: selected fields (all if empty) and server-side queue options."""
+    options = []
+    if queue_size > 0:
+        options.append(f"queueSize={queue_size}")
+    if pipeline:
+        options.append("pipeline=true")
+    record = f"record[{','.join(options)}]" if options else ""
+    return f"{record}field({fields})"
+
+
+class NarrowedUpdate:
+    """
+    Update of a PV monitored with a narrowed pvRequest, presented to PVParser like a full p4p
+    Value: value, alarm and time stamp from the data monitor, metadata from the last event of the
+    metadata monitor, reported as changed when that event is new.
+    """
+
+    __slots__ = ("data", "metadata", "metadata_changed")
+
+    def __init__(self, data: Any, metadata: Any, metadata_changed: bool = False):
+        self.data = data
+        self.metadata = metadata
+        self.metadata_changed = metadata_changed
+
+    def get(self, key: str, default: Any = None) -> Any:
+        source = self.metadata if key in METADATA_FIELDS else self.data
+        if source is None:
+            return default
+        return source.get(key, default)
+
+    def changedSet(self, parents: bool = False) -> Set[str]:
+        changed = self.data.changedSet(parents=parents)
+        if self.metadata_changed and self.metadata is not None:
+            changed = changed | self.metadata.changedSet(parents=parents)
+        return changed
+
 
 class P4PClient:
     """
     Manages PV subscriptions per client_id using p4p.
+    Monitors are created outside the lock and connect in the background.
+    Monitors without subscribers linger in an LRU cache for a grace period before being closed.
+    With narrow_monitor, PVs are monitored with a pvRequest limited to value, alarm and time stamp,
+    and a second monitor receives the metadata once, then only when it changes.
     """
 
-    def __init__(self, handle_update: Callable[[str, Any], None]):
+    def __init__(
+        self,
+        handle_update: Callable[[str, Any], None],
+        handle_status: Callable[[str, bool], None],
+        timeout: float = 5.0,
+        linger_time: float = 30.0,
+        linger_size: int = 1000,
+        narrow_monitor: bool = True,
+        queue_size: int = 0,
+        pipeline: bool = False,
+    ):
         """
         handle_update: callable(pv_name: str, value: object)
+        handle_status: callable(pv_name: str, connected: bool), called on connection changes
+        timeout: timeout in seconds for puts
+        linger_time: seconds a monitor stays open after its last unsubscribe
+        linger_size: max number of lingering monitors
+        narrow_monitor: monitor value fields only, with a separate monitor for metadata
+        queue_size: server-side monitor queue size, 0 for the server default
+        pipeline: enable flow control (pipelining) of monitor updates
         """
-        self._channels: Dict[str, Subscription] = {}
+        # subscribed and lingering monitors, None while being created
+        self._channels: Dict[str, Optional[List[Subscription]]] = {}
+        self._metadata: Dict[str, Any] = {}  # last metadata monitor event, with narrow_monitor
         self._subscribers: Dict[str, Set[str]] = {}  # pv_name -> set(client_ids)
+        self._connected: Set[str] = set()
+        self._latest: Dict[str, Any] = {}  # last value of each monitor, replayed on re-subscribe
         self._handle_update = handle_update
+        self._handle_status = handle_status
+        self._timeout = timeout
         self._ctxt = Context("pva", nt=False)  # nt=False to get unpacked data
+        self._narrow = narrow_monitor
+        self._request = monitor_request(DATA_FIELDS if narrow_monitor else "", queue_size, pipeline)
+        self._metadata_request = monitor_request(",".join(sorted(METADATA_FIELDS)))
         self._lock = threading.Lock()
+        self._update_lock = threading.Lock()  # orders value and metadata updates of narrowed PVs
+        self._linger = LingerCache(self._close_channel, linger_time, linger_size)
+
+    def _set_connected(self, pv_name: str, connected: bool):
+        """Track the connection state of a PV and report transitions of subscribed PVs."""
+        with self._lock:
+            if pv_name not in self._channels or connected == (pv_name in self._connected):
+                return
+            if connected:
+                self._connected.add(pv_name)
+            else:
+                self._connected.discard(pv_name)
+            subscribed = pv_name in self._subscribers
+        if subscribed:
+            self._handle_status(pv_name, connected)
 
     def _on_update(self, pv_name: str) -> Callable[[Any], None]:
-        """Return a callback for monitor updates."""
+        """Return a callback for monitor updates and connection events."""
+
+        def callback(value: Any):
+            if isinstance(value, Cancelled):
+                return
+            if isinstance(value, Exception):
+                if not isinstance(value, Disconnected):
+                    print(f"[p4p]: Monitor error on {pv_name}: {value}")
+                self._set_connected(pv_name, False)
+                return
+            self._set_connected(pv_name, True)
+            if not self._narrow:
+                self._latest[pv_name] = value
+                if pv_name in self._subscribers:
+                    self._handle_update(pv_name, value)
+                return
+            # both monitors of a PV may call back from different threads: keep their order
+            with self._update_lock:
+                value = NarrowedUpdate(value, self._metadata.get(pv_name))
+                self._latest[pv_name] = value
+                if pv_name in self._subscribers:
+                    self._handle_update(pv_name, value)
+
+        return callback
+
+    def _on_metadata(self, pv_name: str) -> Callable[[Any], None]:
+        """Return a callback for metadata monitor events, pushed with the latest value."""
 
         def callback(value: Any):
-            self._handle_update(pv_name, value)
+            if isinstance(value, Exception):
+                if not isinstance(value, (Cancelled, Disconnected)):
+                    print(f"[p4p]: Metadata monitor error on {pv_name}: {value}")
+                return
+            with self._update_lock:
+                self._metadata[pv_name] = value
+                latest = self._latest.get(pv_name)
+                if latest is None:
+                    # the first value update picks the metadata up
+                    return
+                update = NarrowedUpdate(latest.data, value, metadata_changed=True)
+                self._latest[pv_name] = update
+                if pv_name in self._subscribers:
+                    self._handle_update(pv_name, update)
 
         return callback
 
     def subscribe(self, client_id: str, pv_name: str):
-        """Subscribe a single client to a PV."""
+        """Subscribe a single client to a PV, reusing its monitor if it is still lingering."""
         with self._lock:
-            if pv_name not in self._channels:
-                mon = self._ctxt.monitor(pv_name, self._on_update(pv_name))
-                self._channels[pv_name] = mon
-                self._subscribers[pv_name] = set()
-            self._subscribers[pv_name].add(client_id)
+            first_sub = pv_name not in self._subscribers
+            self._subscribers.setdefault(pv_name, set()).add(client_id)
+            lingering = first_sub and pv_name in self._channels
+            if first_sub and not lingering:
+                self._channels[pv_name] = None
+            latest = self._latest.get(pv_name) if pv_name in self._connected else None
+
+        if not first_sub:
+            return
+        self._linger.revive(pv_name)
+        if lingering:
+            if latest is not None:
+                # push the latest value of the lingering monitor to the new subscriber
+                self._handle_update(pv_name, latest)
+            return
+
+        monitors = [
+            self._ctxt.monitor(
+                pv_name, self._on_update(pv_name), request=self._request, notify_disconnect=True
+            )
+        ]
+        if self._narrow:
+            monitors.append(
+                self._ctxt.monitor(
+                    pv_name, self._on_metadata(pv_name), request=self._metadata_request
+                )
+            )
+        with self._lock:
+            registered = pv_name in self._channels
+            if registered:
+                self._channels[pv_name] = monitors
+        if not registered:
+            # closed while the monitors were being created
+            for mon in monitors:
+                mon.close()
 
     def unsubscribe(self, client_id: str, pv_name: str):
-        """Unsubscribe a single client from a PV."""
+        """Unsubscribe a single client from a PV. The monitor lingers after its last client."""
         with self._lock:
-            if pv_name not in self._subscribers:
+            clients = self._subscribers.get(pv_name)
+            if not clients:
                 return
-            self._subscribers[pv_name].discard(client_id)
-
-            if not self._subscribers[pv_name]:
-                mon = self._channels.pop(pv_name, None)
-                if mon:
-                    mon.close()
+            clients.discard(client_id)
+            released = not clients
+            if released:
                 del self._subscribers[pv_name]
 
-    def unsubscribe_all(self, client_id: str):
-        """Remove client_id from all PV subscriptions."""
+        if released:
+            self._linger.release(pv_name)
+
+    def _close_channel(self, pv_name: str):
+        """Close a monitor whose linger period is over, unless it was subscribed again."""
         with self._lock:
-            empty_pvs = []
-            for pv, clients in self._subscribers.items():
-                clients.discard(client_id)
-                if not clients:
-                    empty_pvs.append(pv)
-
-            for pv in empty_pvs:
-                mon = self._channels.pop(pv, None)
-                if mon:
-                    mon.close()
-                del self._subscribers[pv]
+            if pv_name in self._subscribers or pv_name not in self._channels:
+                return
+            monitors = self._channels.pop(pv_name)
+            self._connected.discard(pv_name)
+            self._latest.pop(pv_name, None)
+            self._metadata.pop(pv_name, None)
+
+        for mon in monitors or ():
+            mon.close()
+
+    def is_connected(self, pv_name: str) -> bool:
+        """Whether the channel of a subscribed PV is currently connected."""
+        with self._lock:
+            return pv_name in self._connected
+
+    def linger_stats(self) -> Dict[str, int]:
+        """Size and hit/eviction counters of the lingering monitor cache."""
+        return self._linger.stats()
 
     def write_to_pv(self, pv: str, value: Any):
-        """Write a value to a PV (async)."""
-        mon = self._channels.get(pv)
-        if not mon:
-            print(f"[p4p]: Trying to write to not subscribed PV {pv}. Ignoring.")
-            return
+        """
+        Write a value to a PV, waiting for the server to complete the put.
+        Blocks, so it should be run off the event loop. Raises on failure.
+        """
+        if pv not in self._subscribers or not self._channels.get(pv):
+            raise ValueError(f"Cannot write: PV {pv} not subscribed")
 
-        try:
-            self._ctxt.put(pv, value)
-        except Exception as e:
-            print(f"[p4p]: Write to PV {pv} failed: {e}")
+        self._ctxt.put(pv, value, timeout=self._timeout)
+
+    def get(self, pv_name: str, timeout: float) -> Any:
+        """
+        One-shot read of the full structure of a PV, without monitoring it.
+        Blocks, so it should be run off the event loop. Raises on failure.
+        """
+        return self._ctxt.get(pv_name, timeout=timeout)
 
     def close(self):
         """Close all subscriptions and context."""
+        self._linger.clear()
         with self._lock:
-            for mon in self._channels.values():
-                mon.close()
+            for monitors in self._channels.values():
+                for mon in monitors or ():
+                    mon.close()
             self._channels.clear()
             self._subscribers.clear()
+            self._connected.clear()
+            self._latest.clear()
+            self._metadata.clear()
             self._ctxt.close()
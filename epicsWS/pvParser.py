@@ -1,10 +1,9 @@
 from __future__ import annotations
-from typing import Optional, List, Union, Any
-from dataclasses import dataclass
+from typing import Optional, List, Tuple, Union, Any
+from dataclasses import dataclass, field
 import math
 import base64
 import numpy as np
-from p4p.wrapper import Value as p4pValue
 
 
 # NormativeType data definitions
@@ -55,50 +54,116 @@ class ValueAlarm:
     hysteresis: Optional[int] = None
 
 
+@dataclass
+class PVMetadata:
+    """Metadata of a PV, which rarely changes: parsed once and reused by value-only updates."""
+
+    enumChoices: Optional[List[str]] = None
+    display: Optional[Display] = None
+    control: Optional[Control] = None
+    valueAlarm: Optional[ValueAlarm] = None
+    _fields: Optional[dict] = field(default=None, init=False, repr=False, compare=False)
+
+    def to_dict(self) -> dict:
+        """Message fields of the metadata, built on first use."""
+        if self._fields is None:
+            self._fields = {
+                "enumChoices": self.enumChoices,
+                "display": self.display.__dict__ if self.display else None,
+                "control": self.control.__dict__ if self.control else None,
+                "valueAlarm": self.valueAlarm.__dict__ if self.valueAlarm else None,
+            }
+        return self._fields
+
+
 @dataclass
 class PVData:
     pv: Optional[str] = None
     value: Optional[Union[float, int, List[float], List[int], List[str]]] = None
-    enumChoices: Optional[List[str]] = None
     alarm: Optional[Alarm] = None
     timeStamp: Optional[TimeStamp] = None
-    display: Optional[Display] = None
-    control: Optional[Control] = None
-    valueAlarm: Optional[ValueAlarm] = None
-    b64arr: Optional[str] = None
-    b64dtype: Optional[str] = None
+    metadata: Optional[PVMetadata] = None
+    array: Optional[np.ndarray] = None  # numeric array value, little-endian in its wire dtype
+
+
+# top-level p4p fields holding metadata, and the choices of enum values
+P4P_METADATA_FIELDS = frozenset(["display", "control", "valueAlarm", "value.choices"])
+# set by the caproto client on updates following a (re)read of the control variables
+CA_METADATA_CHANGED = "metadata_changed"
 
 
-def encode_base64_array(array: Union[List, np.ndarray], dtype: str) -> str:
-    arr = np.asarray(array, dtype=dtype)
-    if not arr.dtype.isnative or arr.dtype.byteorder != "<":
-        arr = arr.astype("<" + arr.dtype.str[1:])
+# p4p Value class, resolved on the first PVA update so that CA-only gateways never load p4p
+_p4p_value: Optional[type] = None
+
+
+def p4p_value_type() -> type:
+    """The p4p Value class, imported once."""
+    global _p4p_value
+    if _p4p_value is None:
+        from p4p.wrapper import Value
+
+        _p4p_value = Value
+    return _p4p_value
+
+
+# array dtypes which typed arrays hold as is, sent in their source dtype
+WIRE_DTYPES = frozenset(
+    ["float64", "float32", "int8", "uint8", "int16", "uint16", "int32", "uint32"]
+)
+
+
+def wire_dtype(dtype: np.dtype) -> Optional[str]:
+    """
+    Wire dtype of the arrays of a source dtype, chosen without scanning the data: the source dtype
+    itself when typed arrays support it, float64 for other numbers (64-bit integers), uint8 for
+    booleans. None for non-numeric arrays.
+    """
+    if dtype.name in WIRE_DTYPES:
+        return dtype.name
+    if dtype.kind == "b":
+        return "uint8"
+    if dtype.kind in "iuf":
+        return "float64"
+    return None
+
+
+def to_wire_array(array: Union[List, np.ndarray], dtype: str) -> np.ndarray:
+    """Cast an array to the given dtype in little-endian byte order."""
+    return np.asarray(array, dtype=np.dtype(dtype).newbyteorder("<"))
+
+
+def encode_base64_array(arr: np.ndarray) -> str:
     return base64.b64encode(arr.tobytes()).decode("ascii")
 
 
-def encode_array(arr: Any) -> tuple[Optional[str], Optional[str]]:
-    """Returns (b64arr, b64dtype) for numeric arrays."""
+def encode_array(arr: Any) -> Optional[np.ndarray]:
+    """Returns numeric arrays in their wire dtype, ready for base64 or binary frames."""
     if arr is None:
-        return None, None
+        return None
 
     arr = np.asarray(arr)
     if arr.size == 0:
-        return None, None
+        return None
 
-    if np.issubdtype(arr.dtype, np.floating):
-        return encode_base64_array(arr, "float64"), "float64"
+    dtype = wire_dtype(arr.dtype)
+    return to_wire_array(arr, dtype) if dtype else None
 
-    if np.issubdtype(arr.dtype, np.integer):
-        min_val, max_val = arr.min(), arr.max()
-        if -128 <= min_val <= max_val <= 255:
-            dtype = "int8"
-        elif -32768 <= min_val <= max_val <= 32767:
-            dtype = "int16"
-        else:
-            dtype = "int32"
-        return encode_base64_array(arr, dtype), dtype
 
-    return None, None
+def decimate_minmax(array: np.ndarray, points: int) -> np.ndarray:
+    """
+    Min/max (envelope) decimation of an array to at most `points` values: the array is split into
+    points // 2 bins, each represented by its min and max, so that peaks survive the decimation.
+    NaNs are ignored unless a bin holds only NaNs.
+    """
+    bins = points // 2
+    if bins < 1 or array.size <= points:
+        return array
+
+    starts = (np.arange(bins) * array.size) // bins
+    decimated = np.empty(bins * 2, dtype=array.dtype)
+    decimated[0::2] = np.fmin.reduceat(array, starts)
+    decimated[1::2] = np.fmax.reduceat(array, starts)
+    return decimated
 
 
 def safe_get_nan(obj, k: str):
@@ -106,37 +171,52 @@ def safe_get_nan(obj, k: str):
     return None if isinstance(v, float) and math.isnan(v) else v
 
 
+def normalize_value(v):
+    """Converts numpy types and arrays to JSON-serializable Python types."""
+    if isinstance(v, np.generic):
+        return v.item()
+    elif isinstance(v, np.ndarray):
+        return v.tolist()
+    return v
+
+
 class PVParser:
-    @staticmethod
-    def from_p4p(pv_obj, pv_name: Optional[str] = None) -> PVData:
-        """Converts a p4p NTValue to PVData."""
-        enumChoices = value = b64arr = b64dtype = None
+    """
+    Converts raw provider updates to PVData.
+    Metadata (display, control, value alarm, enum choices) almost never changes, so parsing is
+    split: from_p4p / from_caproto reuse previously parsed metadata when given one, and only parse
+    the value, alarm and time stamp. The *_metadata_changed helpers tell when to parse it again.
+    """
 
-        value_field = pv_obj.get("value")
+    @staticmethod
+    def p4p_sample(pv_obj) -> Tuple[float, Any]:
+        """Time stamp (s since epoch, 0 if unset) and raw value of a p4p update, nothing else."""
+        ts = pv_obj.get("timeStamp", {})
+        seconds = ts.get("secondsPastEpoch", 0) + ts.get("nanoseconds", 0) * 1e-9 if ts else 0.0
+        return seconds, pv_obj.get("value")
 
-        if isinstance(value_field, (int, float, str)):
-            value = value_field
-        elif (
-            isinstance(value_field, p4pValue)
-            and value_field.has("index")
-            and value_field.has("choices")
-        ):
-            value = value_field.get("index")
-            enumChoices = value_field.get("choices")
-        elif isinstance(value_field, (list, np.ndarray)):
-            b64arr, b64dtype = encode_array(value_field)
+    @staticmethod
+    def caproto_sample(pv_obj: dict) -> Tuple[float, Any]:
+        """Time stamp (s since epoch, 0 if unset) and scalar value of a CA update, nothing else."""
+        value = pv_obj.get("value")
+        if isinstance(value, (list, np.ndarray)):
+            value = None
+        return normalize_value(pv_obj.get("timestamp", 0.0)) or 0.0, normalize_value(value)
 
-        a = pv_obj.get("alarm", {})
-        alarm = Alarm(
-            severity=a.get("severity", 0),
-            status=a.get("status", 0),
-        )
+    @staticmethod
+    def p4p_metadata_changed(pv_obj) -> bool:
+        """Whether a p4p monitor update marks any metadata field as changed."""
+        return not P4P_METADATA_FIELDS.isdisjoint(pv_obj.changedSet(parents=True))
 
-        ts = pv_obj.get("timeStamp", {})
-        timestamp = TimeStamp(
-            secondsPastEpoch=ts.get("secondsPastEpoch", 0),
-            nanoseconds=ts.get("nanoseconds", 0),
-            userTag=ts.get("userTag", 0),
+    @staticmethod
+    def p4p_metadata(pv_obj) -> PVMetadata:
+        """Parses the metadata fields of a p4p NTValue."""
+        p4pValue = p4p_value_type()
+        value_field = pv_obj.get("value")
+        enumChoices = (
+            value_field.get("choices")
+            if isinstance(value_field, p4pValue) and value_field.has("choices")
+            else None
         )
 
         d = pv_obj.get("display", {})
@@ -172,47 +252,62 @@ class PVParser:
             hysteresis=va.get("hysteresis"),
         )
 
-        return PVData(
-            pv=pv_name,
-            value=value,
-            enumChoices=enumChoices,
-            alarm=alarm,
-            timeStamp=timestamp,
-            display=display,
-            control=control,
-            valueAlarm=value_alarm,
-            b64arr=b64arr,
-            b64dtype=b64dtype,
+        return PVMetadata(
+            enumChoices=enumChoices, display=display, control=control, valueAlarm=value_alarm
         )
 
     @staticmethod
-    def from_caproto(pv_obj: dict, pv_name: str) -> PVData:
-        """Converts a dict-based CA response to PVData, ensuring JSON-serializable values."""
+    def from_p4p(
+        pv_obj, pv_name: Optional[str] = None, metadata: Optional[PVMetadata] = None
+    ) -> PVData:
+        """Converts a p4p NTValue to PVData. Metadata is parsed unless given."""
+        p4pValue = p4p_value_type()
+        value = array = None
 
-        def normalize_value(v):
-            """Converts numpy types and arrays to JSON-serializable Python types."""
-            if isinstance(v, np.generic):
-                return v.item()
-            elif isinstance(v, np.ndarray):
-                return v.tolist()
-            return v
+        value_field = pv_obj.get("value")
 
-        value = normalize_value(pv_obj.get("value"))
+        if isinstance(value_field, (int, float, str)):
+            value = value_field
+        elif (
+            isinstance(value_field, p4pValue)
+            and value_field.has("index")
+            and value_field.has("choices")
+        ):
+            value = value_field.get("index")
+        elif isinstance(value_field, (list, np.ndarray)):
+            array = encode_array(value_field)
 
-        b64arr, b64dtype = encode_array(value) if isinstance(value, list) else (None, None)
+        a = pv_obj.get("alarm", {})
+        alarm = Alarm(
+            severity=a.get("severity", 0),
+            status=a.get("status", 0),
+        )
 
-        enumChoices = pv_obj.get("enum_strs")
+        ts = pv_obj.get("timeStamp", {})
+        timestamp = TimeStamp(
+            secondsPastEpoch=ts.get("secondsPastEpoch", 0),
+            nanoseconds=ts.get("nanoseconds", 0),
+            userTag=ts.get("userTag", 0),
+        )
 
-        alarm = Alarm(
-            severity=normalize_value(pv_obj.get("severity", 0)),
-            status=normalize_value(pv_obj.get("status", 0)),
-            message=str(pv_obj.get("status", "NO_ALARM")),
+        return PVData(
+            pv=pv_name,
+            value=value,
+            alarm=alarm,
+            timeStamp=timestamp,
+            metadata=metadata or PVParser.p4p_metadata(pv_obj),
+            array=array,
         )
 
-        ts = normalize_value(pv_obj.get("timestamp", 0.0)) or 0.0
-        sec = int(ts)
-        nsec = int((ts - sec) * 1e9)
-        timestamp = TimeStamp(secondsPastEpoch=sec, nanoseconds=nsec)
+    @staticmethod
+    def caproto_metadata_changed(pv_obj: dict) -> bool:
+        """Whether a CA update follows a new read of the control variables."""
+        return bool(pv_obj.get(CA_METADATA_CHANGED))
+
+    @staticmethod
+    def caproto_metadata(pv_obj: dict) -> PVMetadata:
+        """Parses the control variables of a dict-based CA response."""
+        enumChoices = pv_obj.get("enum_strs")
 
         display = Display(
             limitLow=normalize_value(pv_obj.get("lower_disp_limit")),
@@ -235,15 +330,38 @@ class PVParser:
             hysteresis=normalize_value(safe_get_nan(pv_obj, "hyst")),
         )
 
+        return PVMetadata(
+            enumChoices=enumChoices, display=display, control=control, valueAlarm=value_alarm
+        )
+
+    @staticmethod
+    def from_caproto(
+        pv_obj: dict, pv_name: str, metadata: Optional[PVMetadata] = None
+    ) -> PVData:
+        """
+        Converts a dict-based CA response to PVData, ensuring JSON-serializable values.
+        Metadata is parsed unless given.
+        """
+        raw_value = pv_obj.get("value")
+        array = encode_array(raw_value) if isinstance(raw_value, (list, np.ndarray)) else None
+        value = normalize_value(raw_value) if array is None else None
+
+        alarm = Alarm(
+            severity=normalize_value(pv_obj.get("severity", 0)),
+            status=normalize_value(pv_obj.get("status", 0)),
+            message=str(pv_obj.get("status", "NO_ALARM")),
+        )
+
+        ts = normalize_value(pv_obj.get("timestamp", 0.0)) or 0.0
+        sec = int(ts)
+        nsec = int((ts - sec) * 1e9)
+        timestamp = TimeStamp(secondsPastEpoch=sec, nanoseconds=nsec)
+
         return PVData(
             pv=pv_name,
             value=value,
-            enumChoices=enumChoices,
             alarm=alarm,
             timeStamp=timestamp,
-            display=display,
-            control=control,
-            valueAlarm=value_alarm,
-            b64arr=b64arr,
-            b64dtype=b64dtype,
+            metadata=metadata or PVParser.caproto_metadata(pv_obj),
+            array=array,
         )
@@ -0,0 +1,92 @@
+import glob
+import json
+import re
+from typing import Dict, Iterable, List, Union
+
+from frameEncoder import UpdateFrames
+from subscriptionRegistry import ChannelKey
+
+# client id of the provider subscriptions of pre-warmed PVs
+PREWARM_ID = "prewarm"
+
+MACRO = re.compile(r"\$\(([^)]+)\)")
+
+
+def substitute_macros(pv: str, macros: Dict[str, str]) -> str:
+    """Substitute $(NAME) macros in a PV name, keeping those without a value, as the editor does."""
+    return MACRO.sub(lambda m: macros.get(m.group(0), m.group(0)), pv)
+
+
+def opi_pv_names(widgets: List[dict]) -> List[str]:
+    """
+    PV names of the widgets of an OPI file (pvName and pvNames properties, group children
+    included), with the macros of its grid substituted. Names with unknown macros are skipped.
+    """
+    macros: Dict[str, str] = {}
+    for widget in widgets:
+        if widget.get("widgetName") == "GridZone":
+            macros = widget.get("properties", {}).get("macros") or {}
+
+    pvs: List[str] = []
+
+    def collect(widgets: List[dict]):
+        for widget in widgets:
+            properties = widget.get("properties", {})
+            names: Union[List[str], Dict[str, str]] = properties.get("pvNames") or []
+            if isinstance(names, dict):
+                names = list(names.values())
+            for pv in [properties.get("pvName"), *names]:
+                pv = substitute_macros(pv, macros) if pv else None
+                # a macro without value never resolves to a PV
+                if pv and not MACRO.search(pv):
+                    pvs.append(pv)
+            collect(widget.get("children") or [])
+
+    collect(widgets)
+    return pvs
+
+
+def load_pv_names(patterns: Iterable[str]) -> List[str]:
+    """
+    PV names of a set of files, given as paths or glob patterns: OPI files (.json) or PV lists,
+    one PV per line with # comments. Unreadable files are reported and skipped.
+    """
+    pvs: List[str] = []
+    for pattern in patterns:
+        paths = sorted(glob.glob(pattern)) or [pattern]
+        for path in paths:
+            try:
+                with open(path) as f:
+                    if path.endswith(".json"):
+                        pvs.extend(opi_pv_names(json.load(f)))
+                    else:
+                        lines = (line.split("#", 1)[0].strip() for line in f)
+                        pvs.extend(line for line in lines if line)
+            except (OSError, ValueError, AttributeError, TypeError) as e:
+                print(f"[epicsWS]: Failed to read PVs to pre-warm from {path}: {e}")
+    # unique, in order
+    return list(dict.fromkeys(pvs))
+
+
+class PrewarmSubscriber:
+    """
+    Placeholder subscriber of the pre-warmed channels: keeps them subscribed, so their latest update
+    stays cached for the first clients, and discards what is sent to it.
+    """
+
+    client_id = PREWARM_ID
+
+    def __init__(self):
+        self.channel_status: Dict[ChannelKey, bool] = {}
+
+    def send(self, message):
+        pass
+
+    def send_update(self, pv: ChannelKey, frames: UpdateFrames):
+        pass
+
+    def resend_metadata(self, pv: ChannelKey):
+        pass
+
+    def reset_filter(self, pv: ChannelKey):
+        pass
@@ -0,0 +1,91 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+
+@dataclass
+class WriteResult:
+    success: bool
+    latency: float  # seconds from the write request to its completion
+    error: Optional[str] = None
+    superseded: bool = False  # replaced by a newer write before being issued
+
+
+# a write waiting to be issued: (blocking put, request time, future waiting for its result)
+PendingWrite = Tuple[Callable[[], None], float, asyncio.Future]
+
+
+class PVWriter:
+    """
+    Runs blocking provider writes on a thread pool, keeping the event loop responsive.
+    At most one write per key (PV) is in flight: newer values queued meanwhile replace older pending
+    ones, so a burst of writes (e.g. a dragged slider) only puts the latest value once the current
+    put completes.
+    Must be used from within the asyncio event loop.
+    """
+
+    def __init__(self, max_workers: int = 8):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pv-write")
+        self._in_flight: Dict[Hashable, bool] = {}
+        self._pending: Dict[Hashable, PendingWrite] = {}
+
+    def write(self, key: Hashable, put: Callable[[], None]) -> "asyncio.Future[WriteResult]":
+        """
+        Queue a write for a key. Returns a future resolved with the WriteResult once the write
+        completes, or once it is superseded by a newer write to the same key.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        request = (put, time.monotonic(), future)
+
+        if not self._in_flight.get(key):
+            self._start(key, request)
+            return future
+
+        superseded = self._pending.get(key)
+        if superseded:
+            _, requested_at, superseded_future = superseded
+            superseded_future.set_result(
+                WriteResult(
+                    success=False,
+                    latency=time.monotonic() - requested_at,
+                    error="Superseded by a newer write",
+                    superseded=True,
+                )
+            )
+        self._pending[key] = request
+        return future
+
+    def _start(self, key: Hashable, request: PendingWrite):
+        put, requested_at, future = request
+        self._in_flight[key] = True
+        task = asyncio.get_running_loop().run_in_executor(self._executor, put)
+        task.add_done_callback(lambda t: self._on_done(key, t, requested_at, future))
+
+    def _on_done(
+        self,
+        key: Hashable,
+        task: asyncio.Future,
+        requested_at: float,
+        future: asyncio.Future,
+    ):
+        latency = time.monotonic() - requested_at
+        error = task.exception()
+        future.set_result(
+            WriteResult(
+                success=error is None,
+                latency=latency,
+                error=(str(error) or type(error).__name__) if error else None,
+            )
+        )
+
+        pending = self._pending.pop(key, None)
+        if pending:
+            self._start(key, pending)
+        else:
+            self._in_flight.pop(key, None)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,245 @@
+import asyncio
+import concurrent.futures
+import dataclasses
+import itertools
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+from ipcChannel import SharedArrayReader, encode_message, read_message
+from pvParser import PVData, PVMetadata
+
+
+# seconds added to the timeout of the gets forwarded upstream, for the round trip
+GET_MARGIN = 1.0
+
+
+class UpstreamLink:
+    """
+    Connection of a websocket worker to the upstream process of the sharded mode.
+    Dispatches updates and status changes to the RemoteClient of their protocol.
+    Must be used from within the asyncio event loop.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._reader = reader
+        self._writer = writer
+        self._clients: Dict[str, "RemoteClient"] = {}
+        self._writes: Dict[int, asyncio.Future] = {}
+        self._write_ids = itertools.count()
+        self._gets: Dict[int, asyncio.Future] = {}
+        self._get_ids = itertools.count()
+        self._arrays = SharedArrayReader()
+        self.loop = asyncio.get_running_loop()
+        self._task = asyncio.create_task(self._run())
+
+    @classmethod
+    async def connect(cls, path: str) -> "UpstreamLink":
+        reader, writer = await asyncio.open_unix_connection(path)
+        return cls(reader, writer)
+
+    async def wait_closed(self):
+        """Wait until the connection to the upstream process is lost."""
+        await asyncio.shield(self._task)
+
+    def register(self, protocol: str, client: "RemoteClient"):
+        self._clients[protocol] = client
+
+    def send(self, *message):
+        self._writer.write(encode_message(message))
+
+    async def write(self, protocol: str, pv_name: str, value: Any) -> Optional[str]:
+        """Ask upstream to write a PV. Returns the error, None on success."""
+        write_id = next(self._write_ids)
+        future = self._writes[write_id] = self.loop.create_future()
+        self.send("write", write_id, protocol, pv_name, value)
+        return await future
+
+    async def get(
+        self, protocol: str, pv_name: str, timeout: float
+    ) -> Tuple[Optional[PVData], Optional[str]]:
+        """Ask upstream for a one-shot read of a PV. Returns the parsed update or the error."""
+        get_id = next(self._get_ids)
+        future = self._gets[get_id] = self.loop.create_future()
+        self.send("get", get_id, protocol, pv_name, timeout)
+        return await future
+
+    def forget_array(self, protocol: str, pv_name: str):
+        self._arrays.forget((protocol, pv_name))
+
+    async def _run(self):
+        try:
+            while True:
+                message = await read_message(self._reader)
+                kind = message[0]
+                if kind == "update":
+                    _, protocol, pv_name, pv_data, array_ref, metadata = message
+                    client = self._clients.get(protocol)
+                    if client is None:
+                        continue
+                    array = self._arrays.read((protocol, pv_name), array_ref)
+                    if array_ref is not None and array is None:
+                        # array already overwritten upstream, its newer update follows. The
+                        # metadata is kept: upstream sends it once, it is not repeated
+                        client.on_metadata(pv_name, metadata)
+                        continue
+                    client.on_update(pv_name, pv_data, array, metadata)
+                elif kind == "status":
+                    _, protocol, pv_name, connected = message
+                    client = self._clients.get(protocol)
+                    if client is not None:
+                        client.on_status(pv_name, connected)
+                elif kind == "writeResult":
+                    _, write_id, error = message
+                    future = self._writes.pop(write_id, None)
+                    if future is not None and not future.done():
+                        future.set_result(error)
+                elif kind == "getResult":
+                    _, get_id, pv_data, error = message
+                    future = self._gets.pop(get_id, None)
+                    if future is not None and not future.done():
+                        future.set_result((pv_data, error))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            print("[epicsWS]: Lost connection to the upstream process")
+        finally:
+            for future in self._writes.values():
+                if not future.done():
+                    future.set_result("Upstream process unavailable")
+            self._writes.clear()
+            for future in self._gets.values():
+                if not future.done():
+                    future.set_result((None, "Upstream process unavailable"))
+            self._gets.clear()
+            self._arrays.close()
+
+
+class RemoteClient:
+    """
+    Provider client of a websocket worker in sharded mode: same interface as P4PClient and
+    CaprotoClient, but channels live in the upstream process, which sends parsed updates.
+    Only the first subscriber of a PV in this worker subscribes upstream, with the fastest update
+    rate the worker needs for it.
+    Updates are passed on as PVData, reusing the same metadata object until it changes.
+    """
+
+    def __init__(
+        self,
+        protocol: str,
+        link: UpstreamLink,
+        handle_update: Callable[[str, Any], None],
+        handle_status: Callable[[str, bool], None],
+        rate_of: Callable[[str], float],
+        timeout: float = 5.0,
+    ):
+        """
+        protocol: provider of the PVs handled by this client (pva or ca)
+        link: connection to the upstream process
+        handle_update: callable(pv_name: str, pv_data: PVData)
+        handle_status: callable(pv_name: str, connected: bool), called on connection changes
+        rate_of: callable(pv_name) -> fastest update rate needed by the clients of a PV, 0 for all
+        timeout: timeout in seconds for writes, on top of the upstream put timeout
+        """
+        self._protocol = protocol
+        self._link = link
+        self._handle_update = handle_update
+        self._handle_status = handle_status
+        self._rate_of = rate_of
+        self._timeout = timeout
+        self._subscribers: Dict[str, Set[str]] = {}
+        self._rates: Dict[str, float] = {}
+        self._connected: Set[str] = set()
+        self._metadata: Dict[str, PVMetadata] = {}
+        link.register(protocol, self)
+
+    def on_metadata(self, pv_name: str, metadata: Optional[PVMetadata]):
+        """Store the metadata sent with an update, reused by the following value-only updates."""
+        if metadata is not None and pv_name in self._subscribers:
+            self._metadata[pv_name] = metadata
+
+    def on_update(
+        self, pv_name: str, pv_data: PVData, array: Any, metadata: Optional[PVMetadata]
+    ):
+        if pv_name not in self._subscribers:
+            return
+        self.on_metadata(pv_name, metadata)
+        pv_data = dataclasses.replace(
+            pv_data, array=array, metadata=self._metadata.get(pv_name)
+        )
+        self._handle_update(pv_name, pv_data)
+
+    def on_status(self, pv_name: str, connected: bool):
+        if pv_name not in self._subscribers:
+            return
+        if connected:
+            self._connected.add(pv_name)
+        else:
+            self._connected.discard(pv_name)
+        self._handle_status(pv_name, connected)
+
+    def _sync_rate(self, pv_name: str):
+        """Subscribe upstream, or update the rate of the subscription if it changed."""
+        rate = self._rate_of(pv_name)
+        if self._rates.get(pv_name) != rate:
+            self._rates[pv_name] = rate
+            self._link.send("subscribe", self._protocol, pv_name, rate)
+
+    def subscribe(self, client_id: str, pv_name: str):
+        self._subscribers.setdefault(pv_name, set()).add(client_id)
+        self._sync_rate(pv_name)
+
+    def unsubscribe(self, client_id: str, pv_name: str):
+        clients = self._subscribers.get(pv_name)
+        if clients is None:
+            return
+        clients.discard(client_id)
+        if clients:
+            self._sync_rate(pv_name)
+            return
+
+        del self._subscribers[pv_name]
+        self._rates.pop(pv_name, None)
+        self._connected.discard(pv_name)
+        self._metadata.pop(pv_name, None)
+        self._link.forget_array(self._protocol, pv_name)
+        self._link.send("unsubscribe", self._protocol, pv_name)
+
+    def is_connected(self, pv_name: str) -> bool:
+        return pv_name in self._connected
+
+    def linger_stats(self) -> Dict[str, int]:
+        """Channels linger in the upstream process, not in workers."""
+        return {}
+
+    def write_to_pv(self, pv_name: str, value: Any):
+        """
+        Write a PV through the upstream process, waiting for the put to complete.
+        Blocks, so it should be run off the event loop. Raises on failure.
+        """
+        if pv_name not in self._subscribers:
+            raise ValueError(f"Cannot write: PV {pv_name} not subscribed")
+        future = asyncio.run_coroutine_threadsafe(
+            self._link.write(self._protocol, pv_name, value), self._link.loop
+        )
+        error = future.result(timeout=2 * self._timeout)
+        if error is not None:
+            raise RuntimeError(error)
+
+    def get(self, pv_name: str, timeout: float) -> PVData:
+        """
+        One-shot read of a PV through the upstream process, parsed there.
+        Blocks, so it should be run off the event loop. Raises on failure.
+        """
+        future = asyncio.run_coroutine_threadsafe(
+            self._link.get(self._protocol, pv_name, timeout), self._link.loop
+        )
+        try:
+            # upstream answers within the timeout, plus its queueing and the IPC round trip
+            pv_data, error = future.result(timeout=2 * timeout + GET_MARGIN)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise TimeoutError(f"No answer from the upstream process within {timeout:g} s")
+        if error is not None:
+            raise RuntimeError(error)
+        return pv_data
+
+    def close(self):
+        self._subscribers.clear()
+        self._connected.clear()
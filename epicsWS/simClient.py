@@ -0,0 +1,215 @@
+import heapq
+import math
+import threading
+import time
+import zlib
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from urllib.parse import parse_qsl
+
+import numpy as np
+
+from pvParser import CA_METADATA_CHANGED
+
+SHAPES = ("sine", "noise", "ramp")
+
+
+@dataclass
+class SimChannel:
+    """
+    A simulated PV, named <shape>[:<anything>][?<option>=<value>&...]:
+    - shape: sine, noise or ramp
+    - rate: updates per second
+    - size: number of elements, 1 for a scalar
+    - period: seconds per sine or ramp cycle
+    - amp: amplitude of the signal (standard deviation of the noise)
+    The optional part after the shape tells apart independent channels of the same kind, e.g.
+    sine:1?rate=50 and sine:2?rate=50.
+    """
+
+    name: str
+    shape: str
+    rate: float
+    size: int
+    period: float = 10.0
+    amp: float = 1.0
+    metadata_sent: bool = field(default=False, init=False)
+    _rng: np.random.Generator = field(init=False, repr=False)
+    _phase: np.ndarray = field(init=False, repr=False)
+
+    def __post_init__(self):
+        # seeded from the name so that runs are reproducible
+        self._rng = np.random.default_rng(zlib.crc32(self.name.encode()))
+        self._phase = np.arange(self.size) / self.size
+
+    @classmethod
+    def parse(cls, name: str, default_rate: float) -> "SimChannel":
+        """Parse the options of a simulated PV name. Raises ValueError if it is invalid."""
+        path, _, query = name.partition("?")
+        shape = path.split(":", 1)[0]
+        if shape not in SHAPES:
+            raise ValueError(f"unknown shape {shape!r}, expected one of {', '.join(SHAPES)}")
+        options = dict(parse_qsl(query))
+        channel = cls(
+            name,
+            shape,
+            rate=float(options.pop("rate", default_rate)),
+            size=int(options.pop("size", 1)),
+            period=float(options.pop("period", 10.0)),
+            amp=float(options.pop("amp", 1.0)),
+        )
+        if options:
+            raise ValueError(f"unknown options {', '.join(options)}")
+        if channel.rate <= 0 or channel.size < 1 or channel.period <= 0:
+            raise ValueError("rate, size and period must be positive")
+        return channel
+
+    def metadata(self) -> Dict[str, Any]:
+        """Control variables of the channel, in the format of CA updates."""
+        low = 0.0 if self.shape == "ramp" else -self.amp * (3 if self.shape == "noise" else 1)
+        high = self.amp * (3 if self.shape == "noise" else 1)
+        return {
+            "units": "",
+            "precision": 3,
+            "lower_disp_limit": low,
+            "upper_disp_limit": high,
+            "lower_ctrl_limit": low,
+            "upper_ctrl_limit": high,
+        }
+
+    def sample(self, now: float) -> Any:
+        """Value of the channel at a given time: a float, or a float64 array for waveforms."""
+        cycle = now / self.period
+        if self.shape == "noise":
+            value = self._rng.normal(0.0, self.amp, self.size)
+        elif self.shape == "sine":
+            value = self.amp * np.sin(2 * math.pi * (cycle + self._phase))
+        else:
+            value = self.amp * ((cycle + self._phase) % 1.0)
+        return float(value[0]) if self.size == 1 else value
+
+
+class SimClient:
+    """
+    Provider of simulated PVs generated inside the process, for load tests without IOCs.
+    Updates have the format of CA (caproto) updates and go through the same parsing. A single
+    thread generates the updates of all channels, in the order they are due. Channels connect
+    right away and close on their last unsubscribe, and they are read-only.
+    """
+
+    def __init__(
+        self,
+        handle_update: Callable[[str, Any], None],
+        handle_status: Callable[[str, bool], None],
+        default_rate: float = 10.0,
+    ):
+        """
+        handle_update: callable(pv_name: str, raw_data: dict)
+        handle_status: callable(pv_name: str, connected: bool), never called: simulated channels
+            are connected from their subscription on and never disconnect
+        default_rate: update rate (Hz) of channels whose name does not set one
+        """
+        self._handle_update = handle_update
+        self._handle_status = handle_status
+        self._default_rate = default_rate
+        self._channels: Dict[str, SimChannel] = {}
+        self._subscribers: Dict[str, Set[str]] = {}
+        self._schedule: List[Tuple[float, int, SimChannel]] = []  # heap of (due time, seq, channel)
+        self._seq = 0
+        self._closed = False
+        self._wakeup = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def _schedule_channel(self, channel: SimChannel, due: float):
+        self._seq += 1
+        heapq.heappush(self._schedule, (due, self._seq, channel))
+
+    def _run(self):
+        """Generate the updates of the channels as they fall due."""
+        while True:
+            with self._wakeup:
+                while not self._closed and (
+                    not self._schedule or self._schedule[0][0] > time.time()
+                ):
+                    timeout = self._schedule[0][0] - time.time() if self._schedule else None
+                    self._wakeup.wait(timeout)
+                if self._closed:
+                    return
+                now = time.time()
+                due = []
+                while self._schedule and self._schedule[0][0] <= now:
+                    when, _, channel = heapq.heappop(self._schedule)
+                    if self._channels.get(channel.name) is not channel:
+                        continue  # closed
+                    # late channels skip the missed updates instead of bursting
+                    self._schedule_channel(channel, max(when + 1.0 / channel.rate, now))
+                    due.append(channel)
+
+            for channel in due:
+                self._handle_update(channel.name, self._update(channel, now))
+
+    def _update(self, channel: SimChannel, now: float) -> Dict[str, Any]:
+        data = {"value": channel.sample(now), "timestamp": now, "severity": 0, "status": 0}
+        if not channel.metadata_sent:
+            channel.metadata_sent = True
+            data.update(channel.metadata())
+            data[CA_METADATA_CHANGED] = True
+        return data
+
+    def subscribe(self, client_id: str, pv_name: str):
+        """Subscribe a client to a simulated PV, creating its channel on first subscription."""
+        with self._wakeup:
+            first_sub = pv_name not in self._subscribers
+            self._subscribers.setdefault(pv_name, set()).add(client_id)
+            if not first_sub:
+                return
+            try:
+                channel = SimChannel.parse(pv_name, self._default_rate)
+            except ValueError as e:
+                print(f"[sim]: Invalid simulated PV {pv_name}: {e}")
+                return
+            self._channels[pv_name] = channel
+            self._schedule_channel(channel, time.time())
+            self._wakeup.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="sim", daemon=True)
+                self._thread.start()
+        # connected right away: no status callback, subscribers see is_connected() already true
+
+    def unsubscribe(self, client_id: str, pv_name: str):
+        """Unsubscribe a client from a PV, closing its channel once its last client is gone."""
+        with self._wakeup:
+            clients = self._subscribers.get(pv_name)
+            if not clients:
+                return
+            clients.discard(client_id)
+            if not clients:
+                del self._subscribers[pv_name]
+                self._channels.pop(pv_name, None)
+
+    def is_connected(self, pv_name: str) -> bool:
+        """Whether a subscribed PV is valid: simulated channels are connected from the start."""
+        with self._wakeup:
+            return pv_name in self._channels
+
+    def linger_stats(self) -> Dict[str, int]:
+        """Simulated channels do not linger."""
+        return {}
+
+    def get(self, pv_name: str, timeout: float) -> Dict[str, Any]:
+        """Current value of a simulated PV, with its metadata. Raises ValueError if invalid."""
+        channel = SimChannel.parse(pv_name, self._default_rate)
+        return {**self._update(channel, time.time()), **channel.metadata()}
+
+    def write_to_pv(self, pv_name: str, value: Any):
+        raise ValueError(f"Cannot write: simulated PV {pv_name} is read-only")
+
+    def close(self):
+        """Stop generating updates and drop all channels."""
+        with self._wakeup:
+            self._closed = True
+            self._channels.clear()
+            self._subscribers.clear()
+            self._schedule.clear()
+            self._wakeup.notify()
+        print("[sim]: Closed all subscriptions.")
@@ -0,0 +1,86 @@
+from typing import Dict, Hashable, Iterable, Iterator, List, Optional, Set, Tuple
+
+# provider-qualified channel: (provider, pv_name), so that CA and PVA PVs of the same name differ
+ChannelKey = Tuple[str, str]
+
+
+class SubscriptionRegistry:
+    """
+    Subscriptions of subscribers (client sessions, workers) to channels, each at a max update rate.
+    Indexed both ways, channel -> rate -> subscribers and subscriber -> channel -> rate, so that
+    subscribing, unsubscribing and dropping a subscriber cost O(its own subscriptions), whatever
+    the total number of channels.
+    """
+
+    def __init__(self):
+        self._groups: Dict[ChannelKey, Dict[float, Set[Hashable]]] = {}
+        self._subscribers: Dict[ChannelKey, Set[Hashable]] = {}
+        self._channels: Dict[Hashable, Dict[ChannelKey, float]] = {}
+
+    def __contains__(self, key: ChannelKey) -> bool:
+        return key in self._subscribers
+
+    def __iter__(self) -> Iterator[ChannelKey]:
+        """Subscribed channels."""
+        return iter(self._subscribers)
+
+    def add(self, subscriber: Hashable, key: ChannelKey, rate: float) -> Optional[float]:
+        """
+        Subscribe to a channel at a max update rate (Hz, 0 for every update), replacing the rate
+        of an existing subscription. Returns the replaced rate, None if not subscribed yet.
+        """
+        previous = self.remove(subscriber, key)
+        self._subscribers.setdefault(key, set()).add(subscriber)
+        self._groups.setdefault(key, {}).setdefault(rate, set()).add(subscriber)
+        self._channels.setdefault(subscriber, {})[key] = rate
+        return previous
+
+    def remove(self, subscriber: Hashable, key: ChannelKey) -> Optional[float]:
+        """Unsubscribe from a channel. Returns the rate it had, None if it was not subscribed."""
+        channels = self._channels.get(subscriber)
+        rate = channels.pop(key, None) if channels is not None else None
+        if rate is None:
+            return None
+        if not channels:
+            del self._channels[subscriber]
+
+        subscribers = self._subscribers[key]
+        subscribers.discard(subscriber)
+        if not subscribers:
+            del self._subscribers[key]
+        groups = self._groups[key]
+        group = groups[rate]
+        group.discard(subscriber)
+        if not group:
+            del groups[rate]
+            if not groups:
+                del self._groups[key]
+        return rate
+
+    def subscribers(self, key: ChannelKey) -> Set[Hashable]:
+        """Subscribers of a channel. Do not modify."""
+        return self._subscribers.get(key, set())
+
+    def is_subscribed(self, subscriber: Hashable, key: ChannelKey) -> bool:
+        return key in self._channels.get(subscriber, ())
+
+    def group(self, key: ChannelKey, rate: float) -> Set[Hashable]:
+        """Subscribers of a channel at a given rate, flushed together. Do not modify."""
+        return self._groups.get(key, {}).get(rate, set())
+
+    def rates(self, key: ChannelKey) -> Iterable[float]:
+        """Rates of the update groups of a channel."""
+        return self._groups.get(key, {}).keys()
+
+    def max_rate(self, key: ChannelKey) -> float:
+        """Fastest update rate subscribed for a channel, 0 if a subscriber wants every update."""
+        rates = self.rates(key)
+        return 0.0 if not rates or 0.0 in rates else max(rates)
+
+    def channels(self, subscriber: Hashable) -> List[ChannelKey]:
+        """Channels a subscriber is subscribed to."""
+        return list(self._channels.get(subscriber, ()))
+
+    def __len__(self) -> int:
+        """Number of subscribed channels."""
+        return len(self._subscribers)
@@ -0,0 +1,59 @@
+import asyncio
+from typing import Any, Callable, Dict, Hashable
+
+
+class UpdateCoalescer:
+    """
+    Latest-value-wins buffer for PV updates.
+    Holds at most one pending update per key and flushes each key at most `rate` times per second.
+    Must be used from within the asyncio event loop.
+    """
+
+    def __init__(self, flush: Callable[[Hashable, Any], None]):
+        """
+        flush: callable(key, item) invoked from the event loop with the latest item for a key
+        """
+        self._flush = flush
+        self._pending: Dict[Hashable, Any] = {}
+        self._timers: Dict[Hashable, asyncio.TimerHandle] = {}
+        self._last_flush: Dict[Hashable, float] = {}
+
+    def push(self, key: Hashable, item: Any, rate: float):
+        """
+        Queue an item for a key. Flushes immediately if the key is outside its rate window,
+        otherwise replaces any pending item and flushes it when the window opens.
+        A rate <= 0 disables throttling.
+        """
+        if rate <= 0:
+            self._flush(key, item)
+            return
+
+        if key in self._timers:
+            self._pending[key] = item
+            return
+
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        next_flush = self._last_flush.get(key, 0.0) + 1.0 / rate
+        if now >= next_flush:
+            self._last_flush[key] = now
+            self._flush(key, item)
+        else:
+            self._pending[key] = item
+            self._timers[key] = loop.call_at(next_flush, self._on_timer, key)
+
+    def _on_timer(self, key: Hashable):
+        self._timers.pop(key, None)
+        if key not in self._pending:
+            return
+        self._last_flush[key] = asyncio.get_running_loop().time()
+        self._flush(key, self._pending.pop(key))
+
+    def discard(self, key: Hashable):
+        """Drop any pending item and timing state for a key."""
+        timer = self._timers.pop(key, None)
+        if timer:
+            timer.cancel()
+        self._pending.pop(key, None)
+        self._last_flush.pop(key, None)
+
@@ -0,0 +1,308 @@
+import asyncio
+import dataclasses
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Set
+
+import metrics
+from ipcChannel import SharedArrayWriter, encode_message, read_message
+from loopHandoff import LoopHandoff
+from pvPrewarm import PREWARM_ID
+from pvParser import PVData, PVMetadata
+from subscriptionRegistry import ChannelKey, SubscriptionRegistry
+from updateCoalescer import UpdateCoalescer
+
+
+class WorkerLink:
+    """Connection to one websocket worker. Without writer, holds the pre-warmed channels."""
+
+    def __init__(self, worker_id: str, writer: Optional[asyncio.StreamWriter]):
+        self.worker_id = worker_id
+        self.writer = writer
+        self.sent_metadata: Set[ChannelKey] = set()
+
+    def send(self, frame: bytes):
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.write(frame)
+
+
+class UpstreamServer:
+    """
+    Upstream process of the sharded mode: owns the provider clients, so each PV is subscribed
+    upstream only once whatever the number of websocket workers. Updates are coalesced at the
+    fastest rate a worker needs, parsed once and sent to the subscribed workers over a Unix socket,
+    with large arrays passed through shared memory. Metadata is only sent when a worker does not
+    have it yet or when it changed.
+
+    Messages from workers:
+    - ("subscribe", protocol, pv, rate): subscribe, or update the rate of a subscription
+    - ("unsubscribe", protocol, pv)
+    - ("write", id, protocol, pv, value), answered with ("writeResult", id, error or None)
+    - ("get", id, protocol, pv, timeout), answered with ("getResult", id, pv_data, error or None)
+    Messages to workers:
+    - ("update", protocol, pv, pv_data without array and metadata, array or shared ref, metadata)
+    - ("status", protocol, pv, connected)
+    """
+
+    def __init__(
+        self,
+        path: str,
+        create_client: Callable[[str, Callable, Callable], Any],
+        parse_update: Callable[[str, Any, str, Optional[PVMetadata]], PVData],
+        parse_metadata: Callable[[Any, str], PVMetadata],
+        metadata_changed: Callable[[Any, str], bool],
+        max_workers: int = 8,
+        get_workers: int = 32,
+    ):
+        """
+        path: Unix socket path the workers connect to
+        create_client: callable(protocol, handle_update, handle_status) -> provider client
+        parse_update: callable(pv_name, pv_obj, protocol, metadata) -> PVData
+        parse_metadata: callable(pv_obj, protocol) -> PVMetadata
+        metadata_changed: callable(pv_obj, protocol), whether a raw update reports new metadata
+        max_workers: threads running blocking provider writes
+        get_workers: threads running one-shot provider reads
+        """
+        self._path = path
+        self._create_client = create_client
+        self._parse_update = parse_update
+        self._parse_metadata = parse_metadata
+        self._metadata_changed = metadata_changed
+        self._clients: Dict[str, Any] = {}
+        self._links: Dict[str, WorkerLink] = {}
+        # workers subscribed to each channel, at the fastest update rate they need (0: all)
+        self._registry = SubscriptionRegistry()
+        self._latest: Dict[ChannelKey, PVData] = {}  # latest parsed update
+        self._metadata: Dict[ChannelKey, PVMetadata] = {}
+        self._stale_metadata: Set[ChannelKey] = set()
+        self._arrays: Dict[ChannelKey, SharedArrayWriter] = {}
+        self._coalescer = UpdateCoalescer(self._flush_update)
+        self._handoff = LoopHandoff()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pv-write")
+        self._get_executor = ThreadPoolExecutor(
+            max_workers=get_workers, thread_name_prefix="pv-get"
+        )
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._next_worker = 0
+        self._prewarm = WorkerLink(PREWARM_ID, None)
+
+    async def start(self):
+        self._handoff.bind(asyncio.get_running_loop())
+        if os.path.exists(self._path):
+            os.unlink(self._path)
+        self._server = await asyncio.start_unix_server(self._handle_worker, path=self._path)
+
+    def _get_client(self, protocol: str):
+        client = self._clients.get(protocol)
+        if client is None:
+            def handle_update(pv_name, pv_obj):
+                self._handoff.push(self._queue_update, (protocol, pv_name), pv_obj)
+
+            def handle_status(pv_name, connected):
+                self._handoff.push(self._send_status, (protocol, pv_name), connected)
+
+            client = self._clients[protocol] = self._create_client(
+                protocol, handle_update, handle_status
+            )
+        return client
+
+    def prewarm(self, keys: List[ChannelKey], rate: float) -> int:
+        """
+        Subscribe channels before any worker does, and keep them subscribed: their latest update
+        is refreshed at the given rate (Hz) and sent right away to the workers subscribing to them.
+        Channels that fail are reported and skipped. Returns the number of pre-warmed channels.
+        """
+        count = 0
+        for key in keys:
+            try:
+                self._subscribe(self._prewarm, key, rate)
+            except Exception as e:
+                print(f"[epicsWS]: Failed to pre-warm {key[0]}://{key[1]}: {e!r}")
+                self._registry.remove(self._prewarm, key)
+                continue
+            count += 1
+        return count
+
+    async def _handle_worker(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._next_worker += 1
+        link = WorkerLink(f"worker-{self._next_worker}", writer)
+        self._links[link.worker_id] = link
+        print(f"[epicsWS]: Worker connected: {link.worker_id}")
+        try:
+            while True:
+                message = await read_message(reader)
+                kind = message[0]
+                if kind == "subscribe":
+                    self._subscribe(link, (message[1], message[2]), message[3])
+                elif kind == "unsubscribe":
+                    self._unsubscribe(link, (message[1], message[2]))
+                elif kind == "write":
+                    self._write(link, *message[1:])
+                elif kind == "get":
+                    self._get(link, *message[1:])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            # shutdown: end quietly, asyncio < 3.12 logs cancelled connection handlers as errors
+            pass
+        finally:
+            print(f"[epicsWS]: Worker disconnected: {link.worker_id}")
+            for key in self._registry.channels(link):
+                self._unsubscribe(link, key)
+            del self._links[link.worker_id]
+            writer.close()
+
+    def _subscribe(self, link: WorkerLink, key: ChannelKey, rate: float):
+        if self._registry.add(link, key, rate) is not None:
+            return
+
+        protocol, pv_name = key
+        client = self._get_client(protocol)
+        client.subscribe(link.worker_id, pv_name)
+        if client.is_connected(pv_name):
+            link.send(encode_message(("status", protocol, pv_name, True)))
+            latest = self._latest.get(key)
+            if latest is not None:
+                # array sent inline: rewriting the shared slot would invalidate the array refs
+                # other workers have not read yet, with no newer update following for them
+                self._send_update(key, latest, [link], shared=False)
+
+    def _unsubscribe(self, link: WorkerLink, key: ChannelKey):
+        if self._registry.remove(link, key) is None:
+            return
+        link.sent_metadata.discard(key)
+        protocol, pv_name = key
+        self._get_client(protocol).unsubscribe(link.worker_id, pv_name)
+
+        if key not in self._registry:
+            self._coalescer.discard(key)
+            self._latest.pop(key, None)
+            self._metadata.pop(key, None)
+            self._stale_metadata.discard(key)
+            writer = self._arrays.pop(key, None)
+            if writer is not None:
+                writer.close()
+
+    def _queue_update(self, key: ChannelKey, pv_obj):
+        if key not in self._registry:
+            return
+        metrics.updates_in.inc(metrics.channel_labels(key))
+        # checked on every event: the coalescer may skip the update reporting the change
+        if self._metadata_changed(pv_obj, key[0]):
+            self._stale_metadata.add(key)
+        self._coalescer.push(key, pv_obj, self._registry.max_rate(key))
+
+    def _flush_update(self, key: ChannelKey, pv_obj):
+        protocol, pv_name = key
+        metadata = self._metadata.get(key)
+        if metadata is None or key in self._stale_metadata:
+            self._stale_metadata.discard(key)
+            parsed = self._parse_metadata(pv_obj, protocol)
+            if parsed != metadata:
+                metadata = self._metadata[key] = parsed
+                for link in self._registry.subscribers(key):
+                    link.sent_metadata.discard(key)
+
+        pv_data = self._parse_update(pv_name, pv_obj, protocol, metadata)
+        self._latest[key] = pv_data
+        links = self._registry.subscribers(key)
+        if self._prewarm in links:
+            links = links - {self._prewarm}
+        if links:
+            self._send_update(key, pv_data, links)
+
+    def _send_update(self, key: ChannelKey, pv_data: PVData, links, shared: bool = True):
+        """
+        Send a parsed update to workers, encoding each variant (with/without metadata) once.
+        Large arrays go through the shared memory slot of the channel unless shared is False.
+        """
+        protocol, pv_name = key
+        array = pv_data.array
+        if array is not None and shared:
+            array = self._arrays.setdefault(key, SharedArrayWriter()).write(array)
+        value_only = dataclasses.replace(pv_data, array=None, metadata=None)
+
+        frames: Dict[bool, bytes] = {}
+        for link in links:
+            with_metadata = key not in link.sent_metadata
+            link.sent_metadata.add(key)
+            frame = frames.get(with_metadata)
+            if frame is None:
+                metadata = pv_data.metadata if with_metadata else None
+                frame = frames[with_metadata] = encode_message(
+                    ("update", protocol, pv_name, value_only, array, metadata)
+                )
+            link.send(frame)
+
+    def _send_status(self, key: ChannelKey, connected: bool):
+        frame = encode_message(("status", key[0], key[1], connected))
+        for link in self._registry.subscribers(key):
+            link.send(frame)
+
+    def _write(self, link: WorkerLink, write_id: int, protocol: str, pv_name: str, value: Any):
+        """Run a blocking provider write off the loop and report its outcome to the worker."""
+        loop = asyncio.get_running_loop()
+        client = self._get_client(protocol)
+        task = loop.run_in_executor(self._executor, client.write_to_pv, pv_name, value)
+
+        def done(task: asyncio.Future):
+            error = task.exception()
+            error = (str(error) or type(error).__name__) if error else None
+            link.send(encode_message(("writeResult", write_id, error)))
+
+        task.add_done_callback(done)
+
+    def _get(self, link: WorkerLink, get_id: int, protocol: str, pv_name: str, timeout: float):
+        """
+        Reply to a one-shot read with the latest update of a monitored channel, or read the PV off
+        the loop and send it parsed.
+        """
+        latest = self._latest.get((protocol, pv_name))
+        if latest is not None:
+            link.send(encode_message(("getResult", get_id, latest, None)))
+            return
+
+        loop = asyncio.get_running_loop()
+        client = self._get_client(protocol)
+        task = loop.run_in_executor(self._get_executor, client.get, pv_name, timeout)
+
+        def done(task: asyncio.Future):
+            error = task.exception()
+            pv_data = None
+            if error is None:
+                try:
+                    pv_data = self._parse_update(pv_name, task.result(), protocol, None)
+                except Exception as e:
+                    error = e
+            error = (str(error) or type(error).__name__) if error else None
+            link.send(encode_message(("getResult", get_id, pv_data, error)))
+
+        task.add_done_callback(done)
+
+    def channel_stats(self) -> Dict[str, Dict[str, int]]:
+        """Subscribed and connected channels per provider, all workers included."""
+        stats = {protocol: {"subscribed": 0, "connected": 0} for protocol in self._clients}
+        for protocol, pv_name in self._registry:
+            client = self._clients.get(protocol)
+            if client is None:
+                continue
+            stats[protocol]["subscribed"] += 1
+            stats[protocol]["connected"] += client.is_connected(pv_name)
+        return stats
+
+    def linger_stats(self) -> Dict[str, dict]:
+        """Lingering channel cache size and counters per provider."""
+        return {protocol: client.linger_stats() for protocol, client in self._clients.items()}
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+        for writer in self._arrays.values():
+            writer.close()
+        self._arrays.clear()
+        for client in self._clients.values():
+            client.close()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._get_executor.shutdown(wait=False, cancel_futures=True)
+        if os.path.exists(self._path):
+            os.unlink(self._path)
@@ -1,4 +1,12 @@
-import type { PVValue, WSMessage } from "@src/types/epicsWS";
+import type {
+  ArrayDtype,
+  DeadbandOptions,
+  NumericArray,
+  PVHistory,
+  PVValue,
+  WSMessage,
+  WriteResult,
+} from "@src/types/epicsWS";
 
 type ConnectionHandler = (connected: boolean) => void;
 type MessageHandler = (message: WSMessage) => void;
@@ -29,6 +37,40 @@ function base64ToArrayBuffer(b64: string): ArrayBuffer {
   return bytes.buffer;
 }
 
+/**
+ * Wraps a buffer region into the typed array matching the wire dtype, without copying.
+ * @param buffer The buffer holding the array data.
+ * @param dtype The wire data type of the array.
+ * @param byteOffset Offset of the array data in the buffer. Must be aligned to the element size.
+ * @returns The typed array view, or undefined if the dtype is not supported.
+ */
+function toTypedArray(
+  buffer: ArrayBuffer,
+  dtype: string,
+  byteOffset = 0
+): NumericArray | undefined {
+  switch (dtype) {
+    case "float64":
+      return new Float64Array(buffer, byteOffset);
+    case "float32":
+      return new Float32Array(buffer, byteOffset);
+    case "int8":
+      return new Int8Array(buffer, byteOffset);
+    case "uint8":
+      return new Uint8Array(buffer, byteOffset);
+    case "int16":
+      return new Int16Array(buffer, byteOffset);
+    case "uint16":
+      return new Uint16Array(buffer, byteOffset);
+    case "int32":
+      return new Int32Array(buffer, byteOffset);
+    case "uint32":
+      return new Uint32Array(buffer, byteOffset);
+    default:
+      return undefined;
+  }
+}
+
 /**
  * Type guard to check if an object is a WSMessage.
  * @param obj The object to check.
@@ -38,6 +80,70 @@ function isWSMessage(obj: unknown): obj is WSMessage {
   return typeof obj === "object" && obj !== null && ("pv" in obj || "value" in obj);
 }
 
+/**
+ * Type guard to check if an object is a config acknowledgement from the server.
+ * @param obj The object to check.
+ * @returns True if the object is a config message, false otherwise.
+ */
+function isConfigMessage(obj: unknown): obj is {
+  type: "config";
+  binaryArrays?: boolean;
+  deltaUpdates?: boolean;
+  batchUpdates?: boolean;
+} {
+  return typeof obj === "object" && obj !== null && "type" in obj && obj.type === "config";
+}
+
+/**
+ * Type guard to check if an object is a batch of updates.
+ * @param obj The object to check.
+ * @returns True if the object is an updates message, false otherwise.
+ */
+function isUpdatesMessage(obj: unknown): obj is { type: "updates"; updates: unknown[] } {
+  return (
+    typeof obj === "object" &&
+    obj !== null &&
+    "type" in obj &&
+    obj.type === "updates" &&
+    "updates" in obj &&
+    Array.isArray(obj.updates)
+  );
+}
+
+/**
+ * Type guard to check if an object is a write result.
+ * @param obj The object to check.
+ * @returns True if the object is a WriteResult message, false otherwise.
+ */
+function isWriteResult(obj: unknown): obj is WriteResult {
+  return typeof obj === "object" && obj !== null && "type" in obj && obj.type === "writeResult";
+}
+
+/**
+ * Type guard to check if an object is the response to a get request.
+ * @param obj The object to check.
+ * @returns True if the object is a getResult message, false otherwise.
+ */
+function isGetResult(obj: unknown): obj is { type: "getResult"; id: number; results: unknown[] } {
+  return (
+    typeof obj === "object" &&
+    obj !== null &&
+    "type" in obj &&
+    obj.type === "getResult" &&
+    "results" in obj &&
+    Array.isArray(obj.results)
+  );
+}
+
+/**
+ * Type guard to check if an object is a history response.
+ * @param obj The object to check.
+ * @returns True if the object is a history message, false otherwise.
+ */
+function isHistoryMessage(obj: unknown): obj is WSMessage & { type: "history" } {
+  return isWSMessage(obj) && "type" in obj && obj.type === "history";
+}
+
 /**
  * WebSocket client for connecting to the pvaPy WebSocket server.
  * Handles subscribing, unsubscribing, writing, and receiving PV updates.
@@ -46,6 +152,15 @@ export class WSClient {
   private url: string;
   private connection_handler: ConnectionHandler;
   private message_handler: MessageHandler;
+  private binaryArrays: boolean;
+  private deltaUpdates: boolean;
+  private batchUpdates: boolean;
+  private textDecoder = new TextDecoder();
+  private nextWriteId = 0;
+  private pendingWrites = new Map<number, (result: WriteResult) => void>();
+  private pendingHistory = new Map<string, ((history: PVHistory) => void)[]>();
+  private nextGetId = 0;
+  private pendingGets = new Map<number, (results: WSMessage[]) => void>();
 
   private connected = false;
   private socket!: WebSocket;
@@ -56,11 +171,25 @@ export class WSClient {
    * @param url The WebSocket server URL.
    * @param connection_handler Callback for connection status changes.
    * @param message_handler Callback for incoming messages.
+   * @param binaryArrays Whether to request binary frames for array updates (default true).
+   * @param deltaUpdates Whether to request updates carrying only changed fields (default true).
+   * @param batchUpdates Whether to request updates batched into one message per server tick
+   * (default true).
    */
-  constructor(url: string, connection_handler: ConnectionHandler, message_handler: MessageHandler) {
+  constructor(
+    url: string,
+    connection_handler: ConnectionHandler,
+    message_handler: MessageHandler,
+    binaryArrays = true,
+    deltaUpdates = true,
+    batchUpdates = true
+  ) {
     this.url = url;
     this.connection_handler = connection_handler;
     this.message_handler = message_handler;
+    this.binaryArrays = binaryArrays;
+    this.deltaUpdates = deltaUpdates;
+    this.batchUpdates = batchUpdates;
   }
 
   /**
@@ -68,59 +197,185 @@ export class WSClient {
    */
   open(): void {
     this.socket = new WebSocket(this.url);
+    this.socket.binaryType = "arraybuffer";
     this.socket.onopen = (event) => this.handleConnection(event);
-    this.socket.onmessage = (event) => this.handleMessage(event.data as string);
+    this.socket.onmessage = (event) => this.handleMessage(event.data as string | ArrayBuffer);
     this.socket.onclose = (event) => this.handleClose(event);
     this.socket.onerror = (event) => this.handleError(event);
   }
 
   /**
-   * Handles the WebSocket 'open' event and notifies the connection handler.
+   * Handles the WebSocket 'open' event, negotiates the protocol options and notifies the
+   * connection handler.
    * @param _event The open event.
    */
   private handleConnection(_event: Event): void {
     this.connected = true;
+    if (this.binaryArrays || this.deltaUpdates || this.batchUpdates) {
+      this.socket.send(
+        JSON.stringify({
+          type: "config",
+          binaryArrays: this.binaryArrays,
+          deltaUpdates: this.deltaUpdates,
+          batchUpdates: this.batchUpdates,
+        })
+      );
+    }
     this.connection_handler(true);
   }
 
   /**
-   * Handles incoming WebSocket messages, decodes base64 arrays, and forwards them.
-   * @param message The raw WebSocket message string.
+   * Decodes a binary frame: a little-endian uint32 header length, a JSON header and the raw
+   * little-endian array data, which is wrapped in a typed array without copying.
+   * @param buffer The raw binary frame.
+   * @returns The decoded message, or undefined if the frame is invalid.
    */
-  private handleMessage(message: string): void {
+  private decodeBinaryMessage(buffer: ArrayBuffer): WSMessage | undefined {
+    const headerLength = new DataView(buffer).getUint32(0, true);
+    const header: unknown = JSON.parse(
+      this.textDecoder.decode(new Uint8Array(buffer, 4, headerLength))
+    );
+    if (isHistoryMessage(header)) {
+      // payload: count float64 time stamps, then count float64 values
+      const count = header.count ?? 0;
+      const offset = 4 + headerLength;
+      this.resolveHistory({
+        pv: header.pv,
+        times: new Float64Array(buffer, offset, count),
+        values: new Float64Array(buffer, offset + count * 8, count),
+      });
+      return undefined;
+    }
+    if (!isWSMessage(header) || !header.dtype) {
+      console.error("Received invalid binary message header:", header);
+      return undefined;
+    }
+
+    const value = toTypedArray(buffer, header.dtype, 4 + headerLength);
+    if (!value) {
+      console.error("Unsupported dtype:", header.dtype);
+      return undefined;
+    }
+    header.value = value;
+    delete header.dtype;
+    return header;
+  }
+
+  /**
+   * Merges an update into the cached state of its PV. Fields missing from an update (delta or
+   * value-only updates) keep their last received value.
+   * @param msg The received update.
+   * @returns The complete state of the PV.
+   */
+  private mergeUpdate(msg: WSMessage): WSMessage {
+    const merged = { ...this.values[msg.pv], ...msg };
+    this.values[msg.pv] = merged;
+    return merged;
+  }
+
+  /**
+   * Handles incoming WebSocket messages, decodes base64 arrays and binary frames, merges updates
+   * into the PV cache, and forwards them. The entries of batched `updates` messages are
+   * dispatched in one pass, so that their state changes are rendered together.
+   * @param message The raw WebSocket message, a JSON string or a binary frame.
+   */
+  private handleMessage(message: string | ArrayBuffer): void {
+    if (message instanceof ArrayBuffer) {
+      const msg = this.decodeBinaryMessage(message);
+      if (msg) this.message_handler(this.mergeUpdate(msg));
+      return;
+    }
+
     const uncheckedMessage: unknown = JSON.parse(message);
 
+    if (isUpdatesMessage(uncheckedMessage)) {
+      for (const entry of uncheckedMessage.updates) {
+        this.dispatchMessage(entry);
+      }
+      return;
+    }
+
+    if (isConfigMessage(uncheckedMessage)) {
+      this.binaryArrays = uncheckedMessage.binaryArrays ?? false;
+      this.deltaUpdates = uncheckedMessage.deltaUpdates ?? false;
+      this.batchUpdates = uncheckedMessage.batchUpdates ?? false;
+      return;
+    }
+
+    if (isHistoryMessage(uncheckedMessage)) {
+      const msg = uncheckedMessage;
+      const empty = new Float64Array(0);
+      this.resolveHistory({
+        pv: msg.pv,
+        times: msg.b64times ? new Float64Array(base64ToArrayBuffer(msg.b64times)) : empty,
+        values: msg.b64arr ? new Float64Array(base64ToArrayBuffer(msg.b64arr)) : empty,
+      });
+      return;
+    }
+
+    if (isGetResult(uncheckedMessage)) {
+      const results = uncheckedMessage.results.filter(isWSMessage);
+      results.forEach((msg) => this.decodeBase64Value(msg));
+      this.pendingGets.get(uncheckedMessage.id)?.(results);
+      this.pendingGets.delete(uncheckedMessage.id);
+      return;
+    }
+
+    if (isWriteResult(uncheckedMessage)) {
+      this.pendingWrites.get(uncheckedMessage.id)?.(uncheckedMessage);
+      this.pendingWrites.delete(uncheckedMessage.id);
+      return;
+    }
+
+    this.dispatchMessage(uncheckedMessage);
+  }
+
+  /**
+   * Decodes the base64 array of a PV message, merges updates into the PV cache and forwards the
+   * message to the message handler.
+   * @param uncheckedMessage The parsed JSON message.
+   */
+  private dispatchMessage(uncheckedMessage: unknown): void {
     if (!isWSMessage(uncheckedMessage)) {
-      console.error("Received invalid message:", message);
+      console.error("Received invalid message:", uncheckedMessage);
       return;
     }
 
     const msg = uncheckedMessage;
 
-    if (msg.type === "update" && msg.b64arr && msg.b64dtype) {
-      const buffer = base64ToArrayBuffer(msg.b64arr);
-      switch (msg.b64dtype) {
-        case "float64":
-          msg.value = Array.from(new Float64Array(buffer));
-          break;
-        case "int8":
-          msg.value = Array.from(new Int8Array(buffer));
-          break;
-        case "int16":
-          msg.value = Array.from(new Int16Array(buffer));
-          break;
-        case "int32":
-          msg.value = Array.from(new Int32Array(buffer));
-          break;
-        default:
-          console.error("Unsupported b64dtype:", msg.b64dtype);
-          msg.value = [];
-      }
+    if (msg.type === "update") {
+      this.decodeBase64Value(msg);
+    }
+    this.message_handler(msg.type === "update" ? this.mergeUpdate(msg) : msg);
+  }
 
-      delete msg.b64arr;
-      delete msg.b64dtype;
+  /**
+   * Replaces the base64-encoded array of an update by its typed array value, in place.
+   * @param msg The update.
+   */
+  private decodeBase64Value(msg: WSMessage): void {
+    if (!msg.b64arr || !msg.b64dtype) return;
+    const value = toTypedArray(base64ToArrayBuffer(msg.b64arr), msg.b64dtype);
+    if (!value) {
+      console.error("Unsupported b64dtype:", msg.b64dtype);
+    }
+    msg.value = value ?? [];
+
+    delete msg.b64arr;
+    delete msg.b64dtype;
+  }
+
+  /**
+   * Resolves the oldest pending history request of a PV. Responses of a PV arrive in request
+   * order.
+   * @param history The received history.
+   */
+  private resolveHistory(history: PVHistory): void {
+    const pending = this.pendingHistory.get(history.pv);
+    pending?.shift()?.(history);
+    if (pending?.length === 0) {
+      this.pendingHistory.delete(history.pv);
     }
-    this.message_handler(msg);
   }
 
   /**
@@ -138,7 +393,20 @@ export class WSClient {
    */
   private handleClose(event: CloseEvent): void {
     this.connected = false;
+    this.values = {};
     this.connection_handler(false);
+    this.pendingWrites.forEach((resolve, id) =>
+      resolve({ id, pv: "", success: false, latency: 0, error: "Connection closed" })
+    );
+    this.pendingWrites.clear();
+    this.pendingHistory.forEach((pending, pv) =>
+      pending.forEach((resolve) =>
+        resolve({ pv, times: new Float64Array(0), values: new Float64Array(0) })
+      )
+    );
+    this.pendingHistory.clear();
+    this.pendingGets.forEach((resolve) => resolve([]));
+    this.pendingGets.clear();
     let message = `Web socket closed (${event.code}`;
     if (event.reason) {
       message += `, ${event.reason}`;
@@ -160,13 +428,28 @@ export class WSClient {
   /**
    * Subscribes to one or more PVs.
    * @param pvs The PV name or array of PV names to subscribe to.
+   * @param maxRate Optional max update rate (Hz) for these PVs. Omit to use the server default,
+   * 0 disables throttling.
+   * @param maxPoints Optional number of points array PVs are decimated to (min/max envelope).
+   * Omit or use 0 for full resolution.
+   * @param deadband Optional value deadband or alarm-only filtering of the updates of these PVs.
+   * @param arrayDtype Optional wire data type of array values, e.g. float32 to halve the bandwidth
+   * of float64 waveforms. Omit to use the server default.
    */
-  subscribe(pvs: string | string[]): void {
+  subscribe(
+    pvs: string | string[],
+    maxRate?: number,
+    maxPoints?: number,
+    deadband?: DeadbandOptions,
+    arrayDtype?: ArrayDtype
+  ): void {
     if (!this.connected) return;
     if (!Array.isArray(pvs)) {
       pvs = [pvs];
     }
-    this.socket.send(JSON.stringify({ type: "subscribe", pvs }));
+    this.socket.send(
+      JSON.stringify({ type: "subscribe", pvs, maxRate, maxPoints, arrayDtype, ...deadband })
+    );
   }
 
   /**
@@ -185,14 +468,75 @@ export class WSClient {
     }
   }
 
+  /**
+   * Requests the latest update of PVs in full, metadata included.
+   * @param pvs Optional PV name or array of PV names, all subscribed PVs by default.
+   */
+  resync(pvs?: string | string[]): void {
+    if (!this.connected) return;
+    if (pvs !== undefined && !Array.isArray(pvs)) {
+      pvs = [pvs];
+    }
+    this.socket.send(JSON.stringify({ type: "resync", pvs }));
+  }
+
+  /**
+   * Reads the current value of PVs once, metadata included, without subscribing to them. PVs
+   * already subscribed on the server are served from their latest update, the others are read
+   * with one-shot gets.
+   * @param pvs The PV name or array of PV names to read.
+   * @param timeout Optional timeout (s) of the one-shot gets, server default if omitted.
+   * @returns A promise resolved with one message per PV, carrying an `error` if it could not be
+   * read. Resolved with an empty array if the connection is lost. It never rejects.
+   */
+  get(pvs: string | string[], timeout?: number): Promise<WSMessage[]> {
+    if (!this.connected) return Promise.resolve([]);
+    if (!Array.isArray(pvs)) {
+      pvs = [pvs];
+    }
+    const id = this.nextGetId++;
+    return new Promise((resolve) => {
+      this.pendingGets.set(id, resolve);
+      this.socket.send(JSON.stringify({ type: "get", id, pvs, timeout }));
+    });
+  }
+
+  /**
+   * Requests the recent samples of a scalar PV kept by the server, e.g. to backfill a trend
+   * plot when it opens. The server keeps them only if its history is enabled.
+   * @param pv The PV name.
+   * @param since Optional time stamp (seconds past the Unix epoch), only later samples are sent.
+   * @param maxPoints Optional max number of samples, the latest ones.
+   * @returns A promise resolved with the samples, empty if there are none. It never rejects.
+   */
+  history(pv: string, since?: number, maxPoints?: number): Promise<PVHistory> {
+    if (!this.connected) {
+      return Promise.resolve({ pv, times: new Float64Array(0), values: new Float64Array(0) });
+    }
+    return new Promise((resolve) => {
+      const pending = this.pendingHistory.get(pv) ?? [];
+      pending.push(resolve);
+      this.pendingHistory.set(pv, pending);
+      this.socket.send(JSON.stringify({ type: "history", pvs: [pv], since, maxPoints }));
+    });
+  }
+
   /**
    * Writes a value to a PV.
    * @param pv The PV name.
    * @param value The value to write.
+   * @returns A promise resolved with the write result once the server completes (or supersedes)
+   * the write. It never rejects.
    */
-  write(pv: string, value: PVValue): void {
-    if (!this.connected) return;
-    this.socket.send(JSON.stringify({ type: "write", pv, value }));
+  write(pv: string, value: PVValue): Promise<WriteResult> {
+    const id = this.nextWriteId++;
+    if (!this.connected) {
+      return Promise.resolve({ id, pv, success: false, latency: 0, error: "Not connected" });
+    }
+    return new Promise((resolve) => {
+      this.pendingWrites.set(id, resolve);
+      this.socket.send(JSON.stringify({ type: "write", pv, value, id }));
+    });
   }
 
   /**
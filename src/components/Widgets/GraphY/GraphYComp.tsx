@@ -79,6 +79,8 @@ const GraphYComp: React.FC<WidgetUpdate> = ({ data }) => {
             ? [...(valueBuffers.current[pvName] ?? [])]
             : Array.isArray(v)
             ? [...v]
+            : ArrayBuffer.isView(v)
+            ? v
             : null;
 
         if (!y) return null;
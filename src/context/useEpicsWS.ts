@@ -10,6 +10,7 @@ import { WS_URL } from "@src/constants/constants";
  * - Handles subscribing/unsubscribing PVs (using substituted names)
  * - Caches metadata
  * - Forwards updates mapped back to original PVs
+ * - Tracks channel connection states (disconnected PVs lose their alarm state)
  *
  * @param PVMap Map of original PVs to macro-substituted PVs
  * @param updatePVData Callback to update PV data in the widget manager
@@ -48,15 +49,17 @@ export default function useEpicsWS(PVMap: ReturnType<typeof useWidgetManager>["P
       }
 
       const prev = pvCache.current[msg.pv] ?? {};
+      const connected = msg.type === "status" ? msg.status === "connected" : true;
       const pvData: PVData = {
         pv: originalPV,
         value: msg.value ?? prev.value,
         enumChoices: msg.enumChoices ?? prev.enumChoices,
-        alarm: msg.alarm ?? prev.alarm,
+        alarm: connected ? msg.alarm ?? prev.alarm : undefined,
         timeStamp: msg.timeStamp ?? prev.timeStamp,
-        display: prev.display ?? msg.display,
-        control: prev.control ?? msg.control,
-        valueAlarm: prev.valueAlarm ?? msg.valueAlarm,
+        display: msg.display ?? prev.display,
+        control: msg.control ?? prev.control,
+        valueAlarm: msg.valueAlarm ?? prev.valueAlarm,
+        connected,
       };
       pvCache.current[msg.pv] = pvData;
       setPVState((prev) => {
@@ -101,7 +104,11 @@ export default function useEpicsWS(PVMap: ReturnType<typeof useWidgetManager>["P
     (pv: string, newValue: PVValue) => {
       const substituted = PVMap.get(pv);
       if (substituted) {
-        ws.current?.write(substituted, newValue);
+        void ws.current?.write(substituted, newValue).then((result) => {
+          if (!result.success && !result.superseded) {
+            console.error(`writePVValue: write to ${pv} failed: ${result.error}`);
+          }
+        });
       } else {
         console.warn(`writePVValue: unknown PV ${pv}`);
       }
@@ -1,8 +1,40 @@
 /** Type of a WebSocket message, indicating the operation or event */
-export type WSMessageType = "update" | "subscribe" | "unsubscribe" | "write";
+export type WSMessageType =
+  | "update"
+  | "subscribe"
+  | "unsubscribe"
+  | "write"
+  | "writeResult"
+  | "updates"
+  | "config"
+  | "resync"
+  | "history"
+  | "get"
+  | "getResult"
+  | "status";
+
+/** Channel connection state reported by status messages */
+export type PVStatus = "connected" | "disconnected";
+
+/** Typed arrays used for numeric array PVs decoded from the wire */
+export type NumericArray =
+  | Float64Array
+  | Float32Array
+  | Int8Array
+  | Uint8Array
+  | Int16Array
+  | Uint16Array
+  | Int32Array
+  | Uint32Array;
+
+/**
+ * Wire data type requested for numeric arrays: as read from the source, float32 (float arrays
+ * narrowed to single precision) or float64 (all arrays widened)
+ */
+export type ArrayDtype = "native" | "float32" | "float64";
 
 /** Possible PV values: scalar or array of numbers or strings */
-export type PVValue = number | number[] | string | string[];
+export type PVValue = number | number[] | NumericArray | string | string[];
 
 /**
  * EPICS Normative Type support for alarm fields
@@ -95,6 +127,7 @@ export interface ValueAlarm {
  * @property display - Optional EPICS NT display structure
  * @property control - Optional EPICS NT control structure
  * @property valueAlarm - Optional EPICS NT valueAlarm structure
+ * @property connected - Optional channel connection state, undefined until reported
  */
 export interface PVData {
   pv: string;
@@ -105,6 +138,7 @@ export interface PVData {
   display?: Display;
   control?: Control;
   valueAlarm?: ValueAlarm;
+  connected?: boolean;
 }
 
 /**
@@ -113,11 +147,73 @@ export interface PVData {
  * @property type - Type of the message (update, write, subscribe, unsubscribe)
  * @property b64arr - Optional base64-encoded array data
  * @property b64dtype - Optional data type of the base64-encoded array
+ * @property dtype - Data type of the raw array payload of a binary frame
+ * @property binaryArrays - Whether binary array frames are enabled (config messages)
+ * @property deltaUpdates - Whether updates only carry changed fields (config messages)
+ * @property batchUpdates - Whether updates are batched into `updates` messages (config messages)
+ * @property batchInterval - Seconds between batched update messages (config messages)
+ * @property status - Channel connection state (status messages)
+ * @property decimatedFrom - Original length of an array value decimated to the requested points
+ * @property count - Number of samples (history messages)
+ * @property b64times - Base64-encoded float64 time stamps of the samples (history messages)
+ * @property error - Why the PV could not be read (entries of getResult messages)
  */
 export interface WSMessage extends PVData {
   type: WSMessageType;
   b64arr?: string;
   b64dtype?: string;
+  dtype?: string;
+  binaryArrays?: boolean;
+  deltaUpdates?: boolean;
+  batchUpdates?: boolean;
+  batchInterval?: number;
+  status?: PVStatus;
+  decimatedFrom?: number;
+  count?: number;
+  b64times?: string;
+  error?: string;
+}
+
+/**
+ * Outcome of a write, correlated to the request by its id
+ * @property id - Id of the write request
+ * @property pv - Name of the written PV
+ * @property success - Whether the put completed successfully
+ * @property latency - Seconds from the write request to its completion
+ * @property error - Optional failure reason
+ * @property superseded - Optional, true if replaced by a newer write before being issued
+ */
+export interface WriteResult {
+  id: number;
+  pv: string;
+  success: boolean;
+  latency: number;
+  error?: string;
+  superseded?: boolean;
+}
+
+/**
+ * Server-side filtering of the updates of a subscription. Alarm changes always pass
+ * @property deadband - Optional minimum value change, in engineering units
+ * @property deadbandPercent - Optional minimum value change, in percent of the display range
+ * @property alarmOnly - Optional, only send alarm changes
+ */
+export interface DeadbandOptions {
+  deadband?: number;
+  deadbandPercent?: number;
+  alarmOnly?: boolean;
+}
+
+/**
+ * Recent samples of a scalar PV kept by the server, in chronological order
+ * @property pv - Name of the PV
+ * @property times - Time stamps of the samples, in seconds past the Unix epoch
+ * @property values - Values of the samples
+ */
+export interface PVHistory {
+  pv: string;
+  times: Float64Array;
+  values: Float64Array;
 }
 
 /** Collection of PVData objects, keyed by PV name */